@@ -114,7 +114,8 @@ def locate_run(output, target, no_newline):
 def locate_add_arguments(parser):
     parser.add_argument(
         'target',
-        choices=['base', 'config', 'db', 'daemon_pid', 'daemon_log'],
+        choices=['base', 'config', 'db', 'journal', 'daemon_pid',
+                 'daemon_log', 'daemon_socket'],
         help='Name of file to show the path (e.g., config).')
     parser.add_argument(
         '--no-newline', '-n', action='store_true',
@@ -38,6 +38,7 @@ import os
 
 from .utils.confutils import get_config_directory
 from .utils.pathutils import mkdirp
+from .utils.py3compat import execfile
 
 
 class ConfigStore(object):
@@ -51,10 +52,15 @@ class ConfigStore(object):
       `--* rash/                 # base_path
          |--* daemon.pid         # PID of daemon process
          |--* daemon.log         # Log file for daemon
+         |--* daemon.sock        # Socket to send records to daemon
          `--* data/              # data_path
             |--* db.sqlite       # db_path ("indexed" record)
+            |--* journal/        # journal_path ("raw" record journal)
+            |  `--* HOST.journal # records appended by HOST
             `--* record/         # record_path ("raw" record)
                |--* command/     # command log
+               |  `--* HOST/     # records written on HOST
+               |     `--* YYYY-MM-DD/  # ... in this day
                `--* init/        # initialization log
 
     In Mac OS and Windows, :attr:`base_path` may be different but
@@ -83,6 +89,11 @@ class ConfigStore(object):
         Shell history is stored in this directory at the first stage.
         """
 
+        self.journal_path = os.path.join(self.data_path, 'journal')
+        """
+        Shell history is appended to journal files in this directory.
+        """
+
         self.db_path = os.path.join(self.data_path, 'db.sqlite')
         """
         Shell history is stored in the DB at this path.
@@ -98,6 +109,12 @@ class ConfigStore(object):
         Daemon log file (``~/.config/rash/daemon.log``).
         """
 
+        self.daemon_socket_path = os.path.join(self.base_path, 'daemon.sock')
+        """
+        Unix domain socket daemon receives records from
+        (``~/.config/rash/daemon.sock``).
+        """
+
         self.daemon_log_level = 'INFO'  # FIXME: make this configurable
         """
         Daemon log level.
@@ -155,6 +172,8 @@ class Configuration(object):
     |isearch.query|             Default isearch query.
     |isearch.query_template|    Transform default query.
     |isearch.base_query|        Default isearch base query.
+    |database.busy_timeout|     How long to wait for a locked DB.
+    |database.synchronous|      SQLite ``synchronous`` setting.
     =========================== ===========================================
 
     .. |record.environ| replace::
@@ -169,6 +188,10 @@ class Configuration(object):
        :attr:`config.isearch.query_template <ISearchConfig.query_template>`
     .. |isearch.base_query| replace::
        :attr:`config.isearch.base_query <ISearchConfig.base_query>`
+    .. |database.busy_timeout| replace::
+       :attr:`config.database.busy_timeout <DatabaseConfig.busy_timeout>`
+    .. |database.synchronous| replace::
+       :attr:`config.database.synchronous <DatabaseConfig.synchronous>`
 
     """
 
@@ -176,6 +199,7 @@ class Configuration(object):
         self.record = RecordConfig()
         self.search = SearchConfig()
         self.isearch = ISearchConfig()
+        self.database = DatabaseConfig()
 
 
 class RecordConfig(object):
@@ -322,3 +346,38 @@ class ISearchConfig(object):
         """
         Set default value (list of str) for ``--base-query`` option.
         """
+
+
+class DatabaseConfig(object):
+
+    """
+    Configure how the SQLite database is accessed.
+    """
+
+    def __init__(self):
+
+        self.busy_timeout = 5000
+        """
+        Milliseconds to wait when the database is locked by another
+        process before giving up with "database is locked" error.
+
+        As the database is in WAL mode, searches and the daemon do not
+        block each other.  Only writers (e.g., ``rash index`` while
+        the daemon is running) wait for each other.
+
+        >>> config = Configuration()
+        >>> config.database.busy_timeout = 30000
+
+        """
+
+        self.synchronous = 'NORMAL'
+        """
+        Value of ``PRAGMA synchronous`` for connections writing to the
+        database.  One of ``'OFF'``, ``'NORMAL'``, ``'FULL'`` and
+        ``'EXTRA'``.
+
+        ``'NORMAL'`` is safe in WAL mode: the database is never
+        corrupted, though the last transactions may be lost on power
+        failure.  Use ``'FULL'`` to make them durable.
+
+        """
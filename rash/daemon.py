@@ -18,13 +18,16 @@ import os
 
 
 def daemon_run(no_error, restart, record_path, keep_json, check_duplicate,
-               use_polling, log_level):
+               use_polling, log_level, debounce, batch_size, jobs):
     """
     Run RASH index daemon.
 
-    This daemon watches the directory ``~/.config/rash/data/record``
-    and translate the JSON files dumped by ``record`` command into
-    sqlite3 DB at ``~/.config/rash/data/db.sqlite``.
+    This daemon receives records sent by ``record`` command via the
+    socket ``~/.config/rash/daemon.sock``, watches the journals under
+    ``~/.config/rash/data/journal`` and the JSON files under
+    ``~/.config/rash/data/record``, and translate them into sqlite3 DB
+    at ``~/.config/rash/data/db.sqlite``.  When --keep-json is given,
+    the socket is not used so that every record is kept in the journal.
 
     ``rash init`` will start RASH automatically by default.
     But there are alternative ways to start daemon.
@@ -49,11 +52,13 @@ def daemon_run(no_error, restart, record_path, keep_json, check_duplicate,
     """
     # Probably it makes sense to use this daemon to provide search
     # API, so that this daemon is going to be the only process that
-    # is connected to the DB?
+    # is connected to the DB?  Records are already sent to this daemon
+    # via cfstore.daemon_socket_path (see rash.recordsocket).
     from .config import ConfigStore
     from .indexer import Indexer
     from .log import setup_daemon_log_file, LogForTheFuture
     from .watchrecord import watch_record, install_sigterm_handler
+    from .recordsocket import RecordReceiver
 
     install_sigterm_handler()
     cfstore = ConfigStore()
@@ -61,50 +66,118 @@ def daemon_run(no_error, restart, record_path, keep_json, check_duplicate,
         cfstore.daemon_log_level = log_level
     flogger = LogForTheFuture()
 
-    # SOMEDAY: make PID checking/writing atomic if possible
-    flogger.debug('Checking old PID file %r.', cfstore.daemon_pid_path)
-    if os.path.exists(cfstore.daemon_pid_path):
-        flogger.debug('Old PID file exists.  Reading from it.')
-        with open(cfstore.daemon_pid_path, 'rt') as f:
-            pid = int(f.read().strip())
-        flogger.debug('Checking if old process with PID=%d is alive', pid)
-        try:
-            os.kill(pid, 0)     # check if `pid` is alive
-        except OSError:
-            flogger.info(
-                'Process with PID=%d is already dead.  '
-                'So just go on and use this daemon.', pid)
+    flogger.debug('Locking PID file %r.', cfstore.daemon_pid_path)
+    pid_fd = lock_pid_file(cfstore.daemon_pid_path)
+    if pid_fd is None:
+        pid = read_pid_file(cfstore.daemon_pid_path)
+        if restart and pid:
+            flogger.info('Stopping old daemon with PID=%d.', pid)
+            stop_running_daemon(cfstore, pid)
+            pid_fd = lock_pid_file(cfstore.daemon_pid_path)
+    if pid_fd is None:
+        message = ('There is already a running daemon (PID={0})!'
+                   .format(pid))
+        if no_error:
+            flogger.debug(message)
+            # FIXME: Setup log handler and flogger.dump().
+            # Note that using the default log file is not safe
+            # since it has already been used.
+            return
         else:
-            if restart:
-                flogger.info('Stopping old daemon with PID=%d.', pid)
-                stop_running_daemon(cfstore, pid)
-            else:
-                message = ('There is already a running daemon (PID={0})!'
-                           .format(pid))
-                if no_error:
-                    flogger.debug(message)
-                    # FIXME: Setup log handler and flogger.dump().
-                    # Note that using the default log file is not safe
-                    # since it has already been used.
-                    return
-                else:
-                    raise RuntimeError(message)
-    else:
-        flogger.debug('Daemon PID file %r does not exists.  '
-                      'So just go on and use this daemon.',
-                      cfstore.daemon_pid_path)
+            raise RuntimeError(message)
+    flogger.debug('Locked PID file.  So just go on and use this daemon.')
 
-    with open(cfstore.daemon_pid_path, 'w') as f:
-        f.write(str(os.getpid()))
+    os.ftruncate(pid_fd, 0)
+    os.write(pid_fd, str(os.getpid()).encode('ascii'))
 
+    receiver = None
     try:
         setup_daemon_log_file(cfstore)
         flogger.dump()
-        indexer = Indexer(cfstore, check_duplicate, keep_json, record_path)
+        indexer = Indexer(cfstore, check_duplicate, keep_json, record_path,
+                          jobs=jobs)
+        if not keep_json:
+            # Records sent via socket leave no raw record behind.  So,
+            # let "rash record" fall back to the journal when JSON
+            # records should be kept.
+            receiver = RecordReceiver(cfstore.daemon_socket_path)
         indexer.index_all()
-        watch_record(indexer, use_polling)
+        watch_record(indexer, use_polling, receiver, debounce, batch_size)
     finally:
+        if receiver:
+            receiver.close()
+        # Remove the PID file before releasing the lock:
         os.remove(cfstore.daemon_pid_path)
+        os.close(pid_fd)
+
+
+def lock_pid_file(path, retry=10):
+    """
+    Open the PID file at `path` and lock it exclusively.
+
+    The lock is held by the daemon process while it is running and
+    released by the OS when it exits, even if it is killed.  So, a
+    PID file left by a dead daemon can never block a new one.
+
+    :rtype: int or None
+    :return: File descriptor of the locked PID file, or None if
+             another daemon holds the lock.
+
+    """
+    import fcntl
+    import time
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            if retry <= 0:
+                return None
+            # The lock may be taken by is_daemon_alive for an instant.
+            retry -= 1
+            time.sleep(0.05)
+            continue
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                return fd
+        except OSError:
+            pass
+        # The file is removed by the daemon exited while waiting for
+        # the lock.  Lock the new one.
+        os.close(fd)
+
+
+def read_pid_file(path):
+    """
+    Read PID from the file at `path`.  Return None if unknown.
+    """
+    try:
+        with open(path, 'rt') as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_daemon_alive(cfstore):
+    """
+    Check if a daemon is running, without starting any process.
+
+    :rtype: bool
+
+    """
+    import fcntl
+    try:
+        fd = os.open(cfstore.daemon_pid_path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+    return False
 
 
 def stop_running_daemon(cfstore, pid):
@@ -113,7 +186,7 @@ def stop_running_daemon(cfstore, pid):
     os.kill(pid, signal.SIGTERM)
     for _ in range(30):
         time.sleep(0.1)
-        if not os.path.exists(cfstore.daemon_pid_path):
+        if not is_daemon_alive(cfstore):
             break
     else:
         raise RuntimeError(
@@ -177,6 +250,24 @@ def daemon_add_arguments(parser):
         This is useful, for example, when your $HOME is on NFS where
         inotify does not work.
         """)
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="""
+        Number of processes to read JSON records left while the
+        daemon was not running.
+        """)
+    parser.add_argument(
+        '--debounce', type=float, default=0.1, metavar='SECONDS',
+        help="""
+        Wait this many seconds for more records before indexing,
+        so that records arriving in a burst are stored in one
+        transaction.
+        """)
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help="""
+        Maximum number of records to store in one transaction.
+        """)
     parser.add_argument(
         '--log-level',
         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
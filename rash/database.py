@@ -16,19 +16,22 @@
 
 import os
 import re
+import sys
 import sqlite3
 from contextlib import closing, contextmanager
 import datetime
 import warnings
 import itertools
+import threading
 
-from .utils.py3compat import zip_longest
-from .utils.iterutils import nonempty, include_before, include_after, \
-    include_context
+from .utils.py3compat import zip_longest, unichr
+from .utils.iterutils import nonempty
 from .utils.sqlconstructor import SQLConstructor
+from .utils.lrucache import LRUCache
+from .utils.procutils import get_process_context
 from .model import CommandRecord, SessionRecord, VersionRecord, EnvironRecord
 
-schema_version = '0.1'
+schema_version = '0.4'
 
 
 def convert_ts(ts):
@@ -49,6 +52,44 @@ def convert_ts(ts):
     return ts
 
 
+def sql_epoch(expr):
+    """
+    Return SQL expression to convert timestamp `expr` to Unix time.
+
+    >>> sql_epoch('start_time')
+    "CAST(STRFTIME('%s', start_time) AS INTEGER)"
+
+    """
+    return "CAST(STRFTIME('%s', {0}) AS INTEGER)".format(expr)
+
+
+def command_fingerprint(key):
+    """
+    Hash values used to find duplicated command records.
+
+    :type key: list
+    :arg  key: Values returned by :meth:`DataBase._command_record_key`.
+
+    >>> key = ['ls', '/', None, datetime.datetime(2013, 1, 1), None, 0]
+    >>> command_fingerprint(key) == command_fingerprint(
+    ...     ['ls', '/', None, '2013-01-01 00:00:00', None, 0])
+    True
+
+    """
+    import json
+    import hashlib
+    # Timestamps are compared as stored in DB; see convert_ts.
+    data = json.dumps(key, default=str, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def sql_command_fingerprint_func(*key):
+    """
+    :func:`command_fingerprint` as an SQL function of the columns.
+    """
+    return command_fingerprint(list(key))
+
+
 def normalize_directory(path):
     """
     Append "/" to `path` if needed.
@@ -61,8 +102,74 @@ def normalize_directory(path):
         return path + os.path.sep
 
 
-def sql_regexp_func(expr, item):
-    return re.match(expr, item) is not None
+class SQLRegexpFunc(object):
+
+    """
+    REGEXP function for SQLite, compiling each pattern only once.
+
+    An instance is registered to each connection, so that patterns are
+    compiled once per query instead of once per row.  The optional
+    third argument is passed to :func:`re.compile` as `flags`.
+
+    >>> regexp = SQLRegexpFunc()
+    >>> regexp('g.t', 'git status')
+    True
+    >>> regexp('GIT', 'git status')
+    False
+    >>> regexp('GIT', 'git status', re.IGNORECASE)
+    True
+
+    """
+
+    def __init__(self, maxsize=64):
+        self._cache = LRUCache(maxsize)
+
+    def __call__(self, expr, item, flags=0):
+        if item is None:
+            return None
+        key = (expr, flags)
+        compiled = self._cache.get(key)
+        if compiled is None:
+            compiled = self._cache[key] = re.compile(expr, flags)
+        return compiled.match(item) is not None
+
+
+class RegexpMatcher(object):
+
+    """
+    Pick commands matching to regexps as the REGEXP conditions do.
+
+    It is picklable, so that it can be sent to worker processes.
+
+    >>> matcher = RegexpMatcher(['git'], [], ['.*diff'])
+    >>> matcher([(1, 'git status'), (2, 'git diff'), (3, 'hg'), (4, None)])
+    [1]
+
+    """
+
+    def __init__(self, match_regexp, include_regexp, exclude_regexp,
+                 flags=0):
+        self.match_regexp = [re.compile(r, flags) for r in match_regexp]
+        self.include_regexp = [re.compile(r, flags) for r in include_regexp]
+        self.exclude_regexp = [re.compile(r, flags) for r in exclude_regexp]
+
+    def match(self, command):
+        return (
+            all(r.match(command) for r in self.match_regexp) and
+            (not self.include_regexp or
+             any(r.match(command) for r in self.include_regexp)) and
+            not any(r.match(command) for r in self.exclude_regexp))
+
+    def __call__(self, rows):
+        """
+        Return IDs of the commands matching to the regexps.
+
+        :type rows: [(int, str)]
+        :arg  rows: pairs of command_list.id and command.
+
+        """
+        return [i for (i, command) in rows
+                if command is not None and self.match(command)]
 
 
 def sql_program_name_func(command):
@@ -86,6 +193,225 @@ def sql_program_name_func(command):
     return args[0]
 
 
+# As in SQLite, a set is negated by ``^`` and ``]`` just after ``[``
+# or ``[^`` is a member of the set.
+_GLOB_SPECIAL_RE = re.compile(r'\*|\?|\[\^?\]?[^\]]*\]')
+
+
+def glob_fts_query(pattern, minlen=3):
+    """
+    Make an FTS5 query to find candidates matching to glob `pattern`.
+
+    The query matches commands including all literal parts of
+    `pattern` of at least `minlen` characters, ignoring cases.  Return
+    None if there is no such part.
+
+    >>> print(glob_fts_query('*git st*'))
+    "git st"
+    >>> print(glob_fts_query('*a*bcd?ef[gh]ijk"l*'))
+    "bcd" AND "ijk""l"
+    >>> print(glob_fts_query('*ab*'))
+    None
+    >>> print(glob_fts_query('*[^]abc]def*'))
+    "def"
+    >>> print(glob_fts_query('*[!]xyz]abc*'))
+    "xyz]abc"
+
+    """
+    literals = [lit for lit in _GLOB_SPECIAL_RE.split(pattern)
+                if len(lit) >= minlen]
+    if literals:
+        return ' AND '.join(
+            '"{0}"'.format(lit.replace('"', '""')) for lit in literals)
+
+
+_GLOB_WILDCARD_RE = re.compile(r'[*?[]')
+
+
+def glob_literal_prefix(pattern):
+    """
+    Return the literal part of glob `pattern` before any wildcard.
+
+    >>> print(glob_literal_prefix('git commit*'))
+    git commit
+    >>> print(glob_literal_prefix('[gh]it *'))
+    <BLANKLINE>
+    >>> print(glob_literal_prefix('ls'))
+    ls
+
+    """
+    match = _GLOB_WILDCARD_RE.search(pattern)
+    return pattern[:match.start()] if match else pattern
+
+
+_REGEXP_CHAR_CLASSES = set('dDsSwW')
+_REGEXP_ZERO_WIDTH = set('bBAZ')
+
+
+def _skip_regexp_repeat(pattern, i):
+    """
+    Return the index after the repeat (e.g., ``*`` or ``{1,2}?``) at
+    `i` of `pattern`, or `i` itself if there is none.  Return None if
+    the repeat is not understood.
+    """
+    c = pattern[i:i + 1]
+    if c == '{':
+        end = pattern.find('}', i)
+        if end < 0:
+            return None
+        i = end + 1
+    elif c and c in '*+?':
+        i += 1
+    else:
+        return i
+    if pattern[i:i + 1] and pattern[i:i + 1] in '?+':
+        i += 1
+    return i
+
+
+def _regexp_literal_runs(pattern):
+    """
+    Return a list of ``(anchored, literal)`` which every match of
+    regexp `pattern` contains in this order.
+
+    `anchored` is True if the match starts with `literal`.  As
+    :class:`SQLRegexpFunc` uses ``match``, patterns are always
+    anchored at the beginning of commands.  Scanning stops at any
+    construct not understood here (e.g., groups), so that the result
+    is always safe to use as a prefilter.
+
+    >>> _regexp_literal_runs('^git +com+it[.][ch]-*x$')
+    [(True, 'git '), (False, 'com'), (False, 'it'), (False, 'x')]
+    >>> _regexp_literal_runs('make (all)?')
+    [(True, 'make ')]
+    >>> _regexp_literal_runs('git|hg')
+    []
+
+    """
+    if '|' in pattern:
+        return []
+    runs = []
+    chars = []
+    anchored = True
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and \
+                not pattern[i + 1].isalnum():
+            i += 1
+            c = pattern[i]
+        elif c == '\\' and pattern[i + 1:i + 2] in _REGEXP_CHAR_CLASSES:
+            i += 1
+            c = None
+        elif c == '\\' and pattern[i + 1:i + 2] in _REGEXP_ZERO_WIDTH:
+            c = ''
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if pattern[j:j + 1] == '^':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            while j < len(pattern) and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            if j >= len(pattern):
+                break
+            i = j
+            c = None
+        elif c == '.':
+            c = None
+        elif c in '^$':
+            c = ''
+        elif c in '*+?{}()\\':
+            break
+        end = _skip_regexp_repeat(pattern, i + 1)
+        if end is None:
+            break
+        if c and (end == i + 1 or pattern[i + 1] == '+'):
+            # Required character.
+            chars.append(c)
+        if c is None or c == '' or end > i + 1:
+            # Something not literal or a repeated character.
+            if chars:
+                runs.append((anchored, ''.join(chars)))
+            chars = []
+            anchored = False
+        i = end
+    if chars:
+        runs.append((anchored, ''.join(chars)))
+    return runs
+
+
+def regexp_literal_prefix(pattern):
+    """
+    Return the literal string every match of regexp `pattern` starts with.
+
+    >>> print(regexp_literal_prefix('^git.*commit'))
+    git
+    >>> print(regexp_literal_prefix('ls -l?a'))
+    ls -
+    >>> print(regexp_literal_prefix('git|hg'))
+    <BLANKLINE>
+
+    """
+    runs = _regexp_literal_runs(pattern)
+    return runs[0][1] if runs and runs[0][0] else ''
+
+
+def regexp_required_literals(pattern):
+    """
+    Return a list of literal strings every match of regexp `pattern`
+    contains.
+
+    >>> regexp_required_literals('.*git.*(status)?')
+    ['git']
+
+    """
+    return [literal for (_, literal) in _regexp_literal_runs(pattern)]
+
+
+_NOT_ASCII_CASE_FOLDABLE_RE = re.compile(r'[^\x00-\x7f]|[iksIKS]')
+
+
+def ascii_case_foldable_parts(string):
+    """
+    Split `string` into parts in which ``lower()`` of SQLite ignores
+    cases as :data:`re.IGNORECASE` does.
+
+    SQLite only folds ASCII characters and some of them ("i", "k" and
+    "s") match to non-ASCII characters in Python.
+
+    >>> ascii_case_foldable_parts('MAKE -C')
+    ['MA', 'E -C']
+
+    """
+    return [part for part in _NOT_ASCII_CASE_FOLDABLE_RE.split(string)
+            if part]
+
+
+def prefix_upper_bound(prefix):
+    """
+    Return the smallest string after all strings starting with `prefix`.
+
+    Return None if there is no such string.
+
+    >>> print(prefix_upper_bound('make'))
+    makf
+    >>> print(prefix_upper_bound(''))
+    None
+
+    """
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if 0xd800 <= code < 0xe000:
+            # Skip surrogates, which cannot be encoded in UTF-8.
+            code = 0xe000
+        if code <= sys.maxunicode:
+            return prefix[:-1] + unichr(code)
+        prefix = prefix[:-1]
+    return None
+
+
 def sql_pathdist_func(path1, path2, sep=os.path.sep):
     """
     Return a distance between `path1` and `path2`.
@@ -103,28 +429,140 @@ def sql_pathdist_func(path1, path2, sep=os.path.sep):
     return sum(1 for (p1, p2) in zip_longest(seq1, seq2) if p1 != p2)
 
 
+class ConnectionState(object):
+
+    """
+    Connection and transaction state of :class:`DataBase` in a thread.
+    """
+
+    db = None
+    need_commit = False
+    uncommitted_ids = ()
+
+
+class QueryHandle(object):
+
+    """
+    Handle to stop a query of :class:`DataBase` from another thread.
+
+    Pass it to :meth:`DataBase.search_command_record` and call
+    :meth:`interrupt` e.g. from UI thread to cancel the search running
+    in a worker thread.  Queries on other connections are not affected.
+
+    """
+
+    db = None
+    interrupted = False
+
+    def interrupt(self):
+        """
+        Stop the query.  The generator stops iteration quietly.
+        """
+        self.interrupted = True
+        db = self.db
+        if db is not None:
+            db.interrupt()
+
+
+def connect_readonly(path, timeout):
+    """
+    Open a read-only connection to the SQLite database at `path`.
+
+    The ``mode=ro`` URI is used when the sqlite3 module supports it.
+    Otherwise, ``PRAGMA query_only`` is set on a normal connection.
+
+    """
+    try:
+        from urllib import pathname2url
+    except ImportError:
+        from urllib.request import pathname2url
+    uri = 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+    try:
+        return sqlite3.connect(uri, timeout=timeout, uri=True,
+                               check_same_thread=False)
+    except TypeError:
+        db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        db.execute('PRAGMA query_only = ON')
+        return db
+
+
 class DataBase(object):
 
     schemapath = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
 
-    def __init__(self, dbpath):
+    id_cache_size = 10000
+    """
+    Maximum number of IDs cached for each table by :meth:`_get_maybe_new_id`.
+    """
+
+    synchronous_values = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+    def __init__(self, dbpath, readonly=False, config=None):
+        """
+        Open the database at `dbpath`, creating or migrating it first.
+
+        :type   readonly: bool
+        :arg    readonly: Open read-only connections, which never take
+                          write locks.  Use this for searching.
+        :type     config: rash.config.DatabaseConfig or None
+
+        """
+        from .config import DatabaseConfig
         self.dbpath = dbpath
-        if not os.path.exists(dbpath):
-            self._init_db()
-        self.update_version_records()
+        self.config = config or DatabaseConfig()
+        if str(self.config.synchronous).upper() not in \
+                self.synchronous_values:
+            raise ValueError(
+                'Invalid synchronous setting: {0!r}'.format(
+                    self.config.synchronous))
+        if not (readonly and self._is_up_to_date()):
+            if not os.path.exists(dbpath):
+                self._init_db()
+            self.migrate()
+            self.update_version_records()
+        self.readonly = readonly
+    readonly = False
+
+    def _is_up_to_date(self):
+        from .migrations import MIGRATIONS, get_user_version
+        if not os.path.exists(self.dbpath):
+            return False
+        with self._get_db() as db:
+            return get_user_version(db) >= len(MIGRATIONS)
 
     def _get_db(self):
         """Returns a new connection to the database."""
-        return closing(sqlite3.connect(self.dbpath))
+        return closing(self._connect())
+
+    def _connect(self):
+        timeout = self.config.busy_timeout / 1000.0
+        if self.readonly:
+            return connect_readonly(self.dbpath, timeout)
+        # Connections are used by one thread at a time, but a search
+        # generator may be finished in other thread than the one
+        # started it.  See :meth:`connection`.
+        db = sqlite3.connect(self.dbpath, timeout=timeout,
+                             check_same_thread=False)
+        db.execute('PRAGMA synchronous = {0}'.format(
+            self.config.synchronous.upper()))
+        return db
 
     def _init_db(self):
-        """Creates the database tables."""
+        """Creates the database tables of the first schema."""
         with self._get_db() as db:
             with open(self.schemapath) as f:
                 db.cursor().executescript(f.read())
             db.commit()
 
+    def migrate(self):
+        """
+        Apply schema migrations.  See :mod:`rash.migrations`.
+        """
+        from .migrations import migrate
+        with self._get_db() as db:
+            migrate(db)
+
     @contextmanager
     def connection(self, commit=False):
         """
@@ -132,38 +570,60 @@ class DataBase(object):
 
         :rtype: sqlite3.Connection
 
-        SOMEDAY: Get rid of this function.  Keeping connection around as
-        an argument to the method using this context manager is
-        probably better as it is more explicit.
-        Also, holding "global state" as instance attribute is bad for
-        supporting threaded search, which is required for more fluent
-        percol integration.
+        Each thread has its own connection.  Nested calls in the same
+        thread share the connection opened by the outermost one, and
+        the transaction is committed when it exits if any of them is
+        called with ``commit=True``.
+
+        A generator using this context manager keeps the connection
+        of the thread which started iterating it, even if it is
+        finished in another thread.
 
         """
+        state = self._state
         if commit:
-            self._need_commit = True
-        if self._db:
-            yield self._db
+            state.need_commit = True
+        if state.db:
+            yield state.db
         else:
             try:
                 with self._get_db() as db:
-                    self._db = db
-                    db.create_function("REGEXP", 2, sql_regexp_func)
+                    state.db = db
+                    state.uncommitted_ids = []
+                    db.create_function("REGEXP", -1, SQLRegexpFunc())
                     db.create_function("PROGRAM_NAME", 1,
                                        sql_program_name_func)
                     db.create_function("PATHDIST", 2, sql_pathdist_func)
-                    yield self._db
-                    if self._need_commit:
+                    yield db
+                    if state.need_commit:
+                        self._before_commit(db)
                         db.commit()
+                        state.uncommitted_ids = []
             finally:
-                self._db = None
-                self._need_commit = False
-    _db = None
-    _need_commit = False
+                self._discard_uncommitted_ids(state)
+                state.db = None
+                state.need_commit = False
+
+    @property
+    def _state(self):
+        """
+        :class:`ConnectionState` of the current thread.
+        """
+        local = self._local
+        if local is None:
+            with self._local_lock:
+                if self._local is None:
+                    self._local = threading.local()
+                local = self._local
+        if not hasattr(local, 'state'):
+            local.state = ConnectionState()
+        return local.state
+    _local = None
+    _local_lock = threading.Lock()
 
     def close_connection(self):
         """
-        Close connection kept by :meth:`connection`.
+        Close connection kept by :meth:`connection` in this thread.
 
         If commit is needed, :meth:`sqlite3.Connection.commit`
         is called first and then :meth:`sqlite3.Connection.interrupt`
@@ -174,30 +634,87 @@ class DataBase(object):
         - :meth:`search_command_record`
         - :meth:`select_by_command_record`
 
+        To stop them from another thread, use :class:`QueryHandle`.
+
         """
-        if self._db:
-            db = self._db
+        state = self._state
+        if state.db:
+            db = state.db
             try:
-                if self._need_commit:
+                if state.need_commit:
+                    self._before_commit(db)
                     db.commit()
+                    state.uncommitted_ids = []
             finally:
+                self._discard_uncommitted_ids(state)
                 db.interrupt()
-                self._db = None
-                self._need_commit = False
+                state.db = None
+                state.need_commit = False
+
+    def _before_commit(self, db):
+        if not self.readonly:
+            self.sync_command_fts(db)
 
-    def _executing(self, sql, params=[]):
+    def sync_command_fts(self, db):
         """
-        Execute and yield rows in a way to support :meth:`close_connection`.
+        Add commands not in the full-text index to it.
+
+        This is called before committing any change.  Return False if
+        the full-text index is not available.
+
+        """
+        try:
+            last = db.execute('SELECT rowid FROM command_fts '
+                              'ORDER BY rowid DESC LIMIT 1').fetchone()
+        except sqlite3.OperationalError:
+            return False
+        db.execute('INSERT INTO command_fts (rowid, command) '
+                   'SELECT id, command FROM command_list WHERE id > ?',
+                   [last[0] if last else 0])
+        return True
+
+    def _is_command_fts_ready(self):
+        """
+        Return True if all commands are in the full-text index.
         """
         with self.connection() as connection:
-            for row in connection.execute(sql, params):
-                yield row
-                if not self._db:
+            try:
+                fts_last = connection.execute(
+                    'SELECT rowid FROM command_fts '
+                    'ORDER BY rowid DESC LIMIT 1').fetchone()
+            except sqlite3.OperationalError:
+                return False
+            (last,) = connection.execute(
+                'SELECT MAX(id) FROM command_list').fetchone()
+        return (fts_last[0] if fts_last else None) == last
+
+    def _executing(self, sql, params=[], handle=None):
+        """
+        Execute and yield rows in a way to support :meth:`close_connection`
+        and :class:`QueryHandle`.
+        """
+        if handle is None:
+            handle = QueryHandle()
+        with self.connection() as connection:
+            state = self._state
+            handle.db = connection
+            try:
+                if handle.interrupted:
                     return
+                for row in connection.execute(sql, params):
+                    yield row
+                    if state.db is not connection or handle.interrupted:
+                        return
+            except sqlite3.OperationalError:
+                if handle.interrupted:
+                    return
+                raise
+            finally:
+                handle.db = None
 
-    def _select_rows(self, rowclass, keys, sql, params):
+    def _select_rows(self, rowclass, keys, sql, params, handle=None):
         return (rowclass(**dict(zip(keys, row)))
-                for row in self._executing(sql, params))
+                for row in self._executing(sql, params, handle))
 
     def get_version_records(self):
         """
@@ -231,6 +748,26 @@ class DataBase(object):
                 'VALUES (?, ?)',
                 [version, schema_version])
 
+    def get_indexed_files(self):
+        """
+        Get ``{path: (size, mtime, sha1)}`` of the indexed JSON records.
+        """
+        with self.connection() as connection:
+            return dict(
+                (path, (size, mtime, sha1)) for (path, size, mtime, sha1)
+                in connection.execute(
+                    'SELECT path, size, mtime, sha1 FROM indexed_file'))
+
+    def update_indexed_files(self, rows):
+        """
+        Remember JSON records given as ``(path, size, mtime, sha1)``.
+        """
+        with self.connection(commit=True) as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO indexed_file '
+                '(path, size, mtime, sha1) VALUES (?, ?, ?, ?)',
+                rows)
+
     def import_json(self, json_path, **kwds):
         import json
         with open(json_path) as fp:
@@ -252,60 +789,143 @@ class DataBase(object):
             self._isnert_command_environment(db, ch_id, crec.environ)
             self._insert_pipe_status(db, ch_id, crec.pipestatus)
 
+    def import_many(self, dcts, check_duplicate=True, chunk_size=1000):
+        """
+        Import command records `dcts` in one transaction.
+
+        This is the bulk version of :meth:`import_dict`.  Records are
+        inserted every `chunk_size` records by
+        :meth:`sqlite3.Cursor.executemany`, using IDs cached by
+        :meth:`_get_maybe_new_id`.
+
+        """
+        with self.connection(commit=True) as connection:
+            db = connection.cursor()
+            chunk = []
+            keys = set()    # to check duplicates not inserted yet
+            for dct in dcts:
+                crec = CommandRecord(**dct)
+                if check_duplicate:
+                    key = tuple(self._command_record_key(crec))
+                    if key in keys or \
+                       nonempty(self.select_by_command_record(crec)):
+                        continue
+                    keys.add(key)
+                chunk.append(crec)
+                if len(chunk) >= chunk_size:
+                    self._insert_command_records(db, chunk)
+                    chunk = []
+                    keys.clear()
+            if chunk:
+                self._insert_command_records(db, chunk)
+
+    def _insert_command_records(self, db, crecs):
+        rows = [self._command_history_row(db, crec) for crec in crecs]
+        # Insert the first row to get a new ID.  As the transaction
+        # holds the write lock, IDs after it are free to use.
+        first_id = self._insert_command_history_row(db, rows[0])
+        ch_ids = list(range(first_id, first_id + len(rows)))
+        db.executemany(
+            self._sql_insert_command_history(with_id=True),
+            [[ch_id] + row for (ch_id, row) in zip(ch_ids[1:], rows[1:])])
+        self._insert_environ_rows(
+            db, 'command_environment_map', 'ch_id', itertools.chain(*[
+                self._environ_rows(db, ch_id, crec.environ)
+                for (ch_id, crec) in zip(ch_ids, crecs)]))
+        self._insert_pipe_status_rows(db, itertools.chain(*[
+            self._pipe_status_rows(ch_id, crec.pipestatus)
+            for (ch_id, crec) in zip(ch_ids, crecs)]))
+
     def _insert_command_history(self, db, crec):
+        return self._insert_command_history_row(
+            db, self._command_history_row(db, crec))
+
+    def _command_history_row(self, db, crec):
         command_id = self._get_maybe_new_command_id(db, crec.command)
         session_id = self._get_maybe_new_session_id(db, crec.session_id)
         directory_id = self._get_maybe_new_directory_id(db, crec.cwd)
         terminal_id = self._get_maybe_new_terminal_id(db, crec.terminal)
-        db.execute(
-            '''
-            INSERT INTO command_history
-                (command_id, session_id, directory_id, terminal_id,
-                 start_time, stop_time, exit_code)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''',
-            [command_id, session_id, directory_id, terminal_id,
-             convert_ts(crec.start), convert_ts(crec.stop), crec.exit_code])
+        fingerprint = command_fingerprint(self._command_record_key(crec))
+        return [command_id, session_id, directory_id, terminal_id,
+                convert_ts(crec.start), convert_ts(crec.stop), crec.exit_code,
+                fingerprint]
+
+    def _insert_command_history_row(self, db, row):
+        db.execute(self._sql_insert_command_history(), row)
         return db.lastrowid
 
+    @staticmethod
+    def _sql_insert_command_history(with_id=False):
+        """
+        SQL to insert a row of :meth:`_command_history_row`, optionally
+        preceded by ID.
+
+        start_ts, stop_ts and duration are computed from start_time
+        and stop_time in the same way as the migration filling them.
+
+        """
+        columns = ['command_id', 'session_id', 'directory_id', 'terminal_id',
+                   'start_time', 'stop_time', 'exit_code', 'fingerprint']
+        if with_id:
+            columns = ['id'] + columns
+        values = ['?{0:d}'.format(i + 1) for i in range(len(columns))]
+        start = sql_epoch(values[columns.index('start_time')])
+        stop = sql_epoch(values[columns.index('stop_time')])
+        columns += ['start_ts', 'stop_ts', 'duration']
+        values += [start, stop, '{0} - {1}'.format(stop, start)]
+        return 'INSERT INTO command_history ({0}) VALUES ({1})'.format(
+            ', '.join(columns), ', '.join(values))
+
     def _isnert_command_environment(self, db, ch_id, environ):
         self._insert_environ(db, 'command_environment_map', 'ch_id', ch_id,
                              environ)
 
     def _insert_environ(self, db, table, id_name, ch_id, environ):
+        self._insert_environ_rows(db, table, id_name,
+                                  self._environ_rows(db, ch_id, environ))
+
+    def _environ_rows(self, db, ch_id, environ):
         if not environ:
-            return
-        for (name, value) in environ.items():
-            if name is None or value is None:
-                continue
-            ev_id = self._get_maybe_new_id(
+            return []
+        return [
+            (ch_id, self._get_maybe_new_id(
                 db, 'environment_variable',
-                {'variable_name': name, 'variable_value': value})
-            db.execute(
-                '''
-                INSERT INTO {0}
-                    ({1}, ev_id)
-                VALUES (?, ?)
-                '''.format(table, id_name),
-                [ch_id, ev_id])
+                {'variable_name': name, 'variable_value': value}))
+            for (name, value) in environ.items()
+            if name is not None and value is not None]
+
+    def _insert_environ_rows(self, db, table, id_name, rows):
+        db.executemany(
+            '''
+            INSERT INTO {0}
+                ({1}, ev_id)
+            VALUES (?, ?)
+            '''.format(table, id_name),
+            rows)
 
     def _insert_pipe_status(self, db, ch_id, pipe_status):
-        if not pipe_status:
-            return
-        for (i, code) in enumerate(pipe_status):
-            db.execute(
-                '''
-                INSERT INTO pipe_status_map
-                    (ch_id, program_position, exit_code)
-                VALUES (?, ?, ?)
-                ''',
-                [ch_id, i, code])
+        self._insert_pipe_status_rows(
+            db, self._pipe_status_rows(ch_id, pipe_status))
+
+    @staticmethod
+    def _pipe_status_rows(ch_id, pipe_status):
+        return [(ch_id, i, code) for (i, code) in enumerate(pipe_status or [])]
+
+    def _insert_pipe_status_rows(self, db, rows):
+        db.executemany(
+            '''
+            INSERT INTO pipe_status_map
+                (ch_id, program_position, exit_code)
+            VALUES (?, ?, ?)
+            ''',
+            rows)
 
     def _get_maybe_new_command_id(self, db, command):
         if command is None:
             return None
         return self._get_maybe_new_id(
-            db, 'command_list', {'command': command})
+            db, 'command_list', {'command': command},
+            {'program_name': sql_program_name_func(command)})
 
     def _get_maybe_new_session_id(self, db, session_long_id):
         if session_long_id is None:
@@ -326,23 +946,64 @@ class DataBase(object):
         return self._get_maybe_new_id(
             db, 'terminal_list', {'terminal': terminal})
 
-    def _get_maybe_new_id(self, db, table, columns):
-        kvlist = list(columns.items())
+    def _get_maybe_new_id(self, db, table, columns, extra={}):
+        """
+        Get ID of the row in `table` having `columns`.
+
+        If there is no such row, insert a new one with `columns` and
+        `extra`.  `extra` must be a function of `columns`.
+
+        """
+        kvlist = sorted(columns.items())
         values = [v for (_, v) in kvlist]
+        cache = self._get_id_cache(table)
+        key = tuple(values)
+        id_val = cache.get(key)
+        if id_val is not None:
+            return id_val
         sql_select = 'SELECT id FROM "{0}" WHERE {1}'.format(
             table,
             ' AND '.join(map('"{0[0]}" = ?'.format, kvlist)),
         )
         for (id_val,) in db.execute(sql_select, values):
+            cache[key] = id_val
             return id_val
+        kvlist += sorted(extra.items())
         sql_insert = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
             table,
             ', '.join(map('"{0[0]}"'.format, kvlist)),
             ', '.join('?' for _ in kvlist),
         )
-        db.execute(sql_insert, values)
+        db.execute(sql_insert, [v for (_, v) in kvlist])
+        cache[key] = db.lastrowid
+        self._state.uncommitted_ids.append((table, key))
         return db.lastrowid
 
+    def _get_id_cache(self, table):
+        """
+        Get a cache of ``{values: id}`` for `table`.
+
+        Rows in these tables are never deleted and the looked up columns
+        never change, so a cached ID is valid as long as the transaction
+        inserted it is committed.
+        See :meth:`_discard_uncommitted_ids`.
+
+        """
+        if self._id_caches is None:
+            self._id_caches = {}
+        if table not in self._id_caches:
+            self._id_caches[table] = LRUCache(self.id_cache_size)
+        return self._id_caches[table]
+    _id_caches = None
+
+    def _discard_uncommitted_ids(self, state):
+        """
+        Forget IDs inserted by a transaction which is not committed.
+        """
+        for (table, key) in state.uncommitted_ids:
+            self._id_caches[table].pop(key)
+        state.uncommitted_ids = []
+
     def select_by_command_record(self, crec):
         """
         Yield records that matches to `crec`.
@@ -363,6 +1024,7 @@ class DataBase(object):
         LEFT JOIN directory_list AS DL ON directory_id = DL.id
         LEFT JOIN terminal_list AS TL ON terminal_id = TL.id
         WHERE
+            fingerprint = ? AND
             (CL.command   = ? OR (CL.command   IS NULL AND ? IS NULL)) AND
             (DL.directory = ? OR (DL.directory IS NULL AND ? IS NULL)) AND
             (TL.terminal  = ? OR (TL.terminal  IS NULL AND ? IS NULL)) AND
@@ -370,56 +1032,210 @@ class DataBase(object):
             (stop_time    = ? OR (stop_time    IS NULL AND ? IS NULL)) AND
             (exit_code    = ? OR (exit_code    IS NULL AND ? IS NULL))
         """
-        desired_row = [
+        desired_row = self._command_record_key(crec)
+        params = [command_fingerprint(desired_row)]
+        params.extend(itertools.chain(*zip(desired_row, desired_row)))
+        return self._select_rows(CommandRecord, keys, sql, params)
+
+    @staticmethod
+    def _command_record_key(crec):
+        """
+        Values of `crec` used to find duplicates.
+        """
+        return [
             crec.command, normalize_directory(crec.cwd), crec.terminal,
             convert_ts(crec.start), convert_ts(crec.stop), crec.exit_code]
-        params = list(itertools.chain(*zip(desired_row, desired_row)))
-        return self._select_rows(CommandRecord, keys, sql, params)
+
+    regexp_parallel_threshold = 10000
+    """
+    Minimum number of distinct commands to match regexps in parallel.
+    """
 
     def search_command_record(
             self,
             after_context, before_context, context, context_type,
-            **kwds):
+            jobs=1, handle=None, **kwds):
         """
         Search command history.
 
+        :type handle: QueryHandle
         :rtype: [CommandRecord]
 
+        When `jobs` is more than one, regexps are matched against the
+        distinct commands by that many processes before querying.
+        Pass `handle` to stop the search from another thread.
+
         """
         if after_context or before_context or context:
-            kwds['condition_as_column'] = True
-            limit = kwds['limit']
-            kwds['limit'] = -1
             kwds['unique'] = False
             kwds['sort_by'] = {
                 'session': ['session_start_time', 'start_time'],
                 'time': ['start_time'],
-            }[context_type]
+            }[context_type] + ['command_history.id']
             if not kwds['reverse']:
                 # Default (reverse=False) means latest history comes first.
                 after_context, before_context = before_context, after_context
 
+        if kwds['match_pattern'] or kwds['include_pattern']:
+            kwds['use_fts'] = self._is_command_fts_ready()
+        if jobs > 1 and (kwds['match_regexp'] or kwds['include_regexp'] or
+                         kwds['exclude_regexp']):
+            kwds['command_ids'] = self._match_regexp_in_pool(
+                jobs, kwds['match_regexp'], kwds['include_regexp'],
+                kwds['exclude_regexp'], kwds['ignore_case'])
         (sql, params, keys) = self._compile_sql_search_command_record(**kwds)
-        records = self._select_rows(CommandRecord, keys, sql, params)
+        if not (after_context or before_context or context):
+            return self._select_rows(CommandRecord, keys, sql, params,
+                                     handle)
 
-        # SOMEDAY: optimize context search;  do not create CommandRecord
-        #          object for all (including non-matching) records.
-        predicate = lambda r: r.condition
         if context:
-            records = include_context(predicate, context, records)
+            (before, after) = (context, context)
         elif before_context:
-            records = include_before(predicate, before_context, records)
-        elif after_context:
-            records = include_after(predicate, after_context, records)
-        if after_context or before_context or context and limit >= 0:
-            records = itertools.islice(records, limit)
-        # NOTE: as SQLite does not support row_number function, let's
-        #       do the filtering at Python side when context modifier
-        #       is given.  This is *very* inefficient but at least it
-        #       works..
-
+            (before, after) = (before_context, 0)
+        else:
+            (before, after) = (0, after_context)
+        records = self._include_context(
+            keys, sql, params, kwds, before, after,
+            context_type == 'session', handle)
+        # `sql` is limited as well, since each match yields at least
+        # one record.
+        if kwds['limit'] >= 0:
+            records = itertools.islice(records, kwds['limit'])
         return records
 
+    def _include_context(self, keys, sql, params, kwds, before, after,
+                         same_session, handle=None):
+        """
+        Yield records matched by `sql` and `before`/`after` records
+        around each of them.
+
+        `before` and `after` are in the order of the result.  Records
+        around a match are looked up by :meth:`_context_ids`, so the
+        cost depends on the number of matches, not on the size of the
+        history.
+
+        """
+        kwds = dict(kwds, limit=-1, command_ids=None, use_fts=False,
+                    **dict.fromkeys(self._search_condition_keys, []))
+        reverse = kwds['reverse']
+        index = keys.index('command_history_id')
+        with self.connection() as connection:
+            matches = (row[index]
+                       for row in self._executing(sql, params, handle))
+            window = set()
+            try:
+                while True:
+                    batch = list(itertools.islice(
+                        matches, self.context_batch_size))
+                    if not batch:
+                        return
+                    ids = []
+                    for match_id in batch:
+                        around = (
+                            self._context_ids(connection, match_id, before,
+                                              not reverse, same_session)[::-1]
+                            + [match_id] +
+                            self._context_ids(connection, match_id, after,
+                                              reverse, same_session))
+                        # A window overlaps only with the previous one.
+                        ids.extend(i for i in around if i not in window)
+                        window = set(around)
+                    (wsql, wparams, wkeys) = \
+                        self._compile_sql_search_command_record(
+                            history_ids=ids, **kwds)
+                    rows = dict((r[index], r) for r in
+                                connection.execute(wsql, wparams))
+                    for i in ids:
+                        yield CommandRecord(**dict(zip(wkeys, rows[i])))
+            except sqlite3.OperationalError:
+                if handle is not None and handle.interrupted:
+                    return
+                raise
+
+    context_batch_size = 100
+    """
+    Number of matches of which context records are read at once.
+    """
+
+    _search_condition_keys = [
+        'match_pattern', 'include_pattern', 'exclude_pattern',
+        'match_regexp', 'include_regexp', 'exclude_regexp',
+        'cwd', 'cwd_glob', 'cwd_under',
+        'time_after', 'time_before',
+        'duration_longer_than', 'duration_less_than',
+        'include_exit_code', 'exclude_exit_code',
+        'include_session_history_id', 'exclude_session_history_id',
+        'match_environ_pattern', 'include_environ_pattern',
+        'exclude_environ_pattern',
+        'match_environ_regexp', 'include_environ_regexp',
+        'exclude_environ_regexp',
+    ]
+    """
+    Keyword arguments of :meth:`_compile_sql_search_command_record`
+    filtering records, which are not applied to the context records.
+    """
+
+    @staticmethod
+    def _context_ids(connection, history_id, num, later, same_session):
+        """
+        Return IDs of `num` commands run just after (if `later` is
+        true) or before the command of `history_id`, nearest first.
+
+        Commands are ordered by start time and then by ID.  The rows
+        are read by the index on ``start_time``, or on ``(session_id,
+        start_time)`` if `same_session` is true, which also include
+        the ID.
+
+        """
+        if num <= 0:
+            return []
+        (cmp, order) = ('>', 'ASC') if later else ('<', 'DESC')
+        sql = (
+            'SELECT H.id FROM command_history AS M, command_history AS H '
+            'WHERE M.id = ? AND H.start_time {cmp}= M.start_time '
+            'AND (H.start_time {cmp} M.start_time OR H.id {cmp} M.id)'
+            '{session} ORDER BY H.start_time {order}, H.id {order} LIMIT ?'
+        ).format(
+            cmp=cmp, order=order,
+            session=' AND H.session_id IS M.session_id' if same_session
+            else '')
+        return [row[0] for row in connection.execute(sql, [history_id, num])]
+
+    def _match_regexp_in_pool(self, jobs, match_regexp, include_regexp,
+                              exclude_regexp, ignore_case):
+        """
+        Return IDs of the commands matching to the regexps, or None if
+        there are not enough commands to do it in parallel.
+        """
+        from .log import logger
+        with self.connection() as connection:
+            rows = connection.execute(
+                'SELECT id, command FROM command_list').fetchall()
+        if len(rows) < self.regexp_parallel_threshold:
+            return None
+        context = get_process_context()
+        if context is None and threading.active_count() > 1:
+            # Searches may run in a worker thread (e.g., isearch).
+            logger.debug('Not forking, as other threads are running.')
+            return None
+
+        import multiprocessing
+        logger.debug('Matching regexps to %d commands by %d processes.',
+                     len(rows), jobs)
+        matcher = RegexpMatcher(match_regexp, include_regexp, exclude_regexp,
+                                re.IGNORECASE if ignore_case else 0)
+        size = len(rows) // (jobs * 4) + 1
+        chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+        pool = (context or multiprocessing).Pool(jobs)
+        try:
+            ids = list(itertools.chain.from_iterable(
+                pool.imap_unordered(matcher, chunks)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return ids
+
     @classmethod
     def _compile_sql_search_command_record(
             cls, limit, unique,
@@ -435,7 +1251,8 @@ class DataBase(object):
             exclude_environ_regexp,
             reverse, sort_by, sort_by_cwd_distance,
             ignore_case,
-            additional_columns=[], condition_as_column=False,
+            additional_columns=[],
+            use_fts=False, command_ids=None, history_ids=None,
             ):
         keys = ['command_history_id', 'command', 'session_history_id',
                 'cwd', 'terminal',
@@ -455,9 +1272,10 @@ class DataBase(object):
 
         if ignore_case:
             glob = "glob(lower({1}), lower({0}))".format
+            regexp = "regexp({{1}}, {{0}}, {0:d})".format(re.IGNORECASE)
         else:
             glob = "glob({1}, {0})".format
-        regexp = "regexp({1}, {0})"
+            regexp = "regexp({1}, {0})"
         eq = '{0} = {1}'
 
         if not unique and 'command_count' in sort_by:
@@ -466,6 +1284,29 @@ class DataBase(object):
             # should mean to ignore ``sort_by='command_count'``.
             sort_by = [k for k in sort_by if k != 'command_count']
 
+        # Read aggregated values from command_stats instead of
+        # grouping the whole command_history, if the conditions do not
+        # depend on each command_history row.
+        use_stats = unique and not (
+            cwd or cwd_glob or time_after or time_before or
+            duration_longer_than or duration_less_than or
+            include_exit_code or exclude_exit_code or
+            include_session_history_id or exclude_session_history_id or
+            match_environ_pattern or include_environ_pattern or
+            exclude_environ_pattern or
+            match_environ_regexp or include_environ_regexp or
+            exclude_environ_regexp or
+            sort_by_cwd_distance or history_ids is not None)
+        sort_keys = {}
+        if use_stats:
+            source = (
+                'command_stats AS CS '
+                'LEFT JOIN command_list AS CL ON CS.command_id = CL.id '
+                'JOIN command_history ON CS.last_id = command_history.id '
+                'LEFT JOIN directory_list AS DL ON directory_id = DL.id '
+                'LEFT JOIN terminal_list AS TL ON terminal_id = TL.id')
+            sort_keys['start_time'] = 'CS.last_start'
+
         sc = SQLConstructor(source, columns, keys, limit=limit)
         if sort_by_cwd_distance:
             col_cwd_dist = 'PATHDIST(DL.directory, ?)'
@@ -476,21 +1317,51 @@ class DataBase(object):
             sc.add_column(col_cwd_dist, 'cwd_distance', params=[path0])
             sc.order_by('cwd_distance', 'DESC' if reverse else 'ASC')
         for k in sort_by:
-            sc.order_by(k, 'ASC' if reverse else 'DESC')
-        sc.add_matches(glob, 'CL.command',
-                       match_pattern, include_pattern, exclude_pattern)
-        sc.add_matches(regexp, 'CL.command',
-                       match_regexp, include_regexp, exclude_regexp)
+            sc.order_by(sort_keys.get(k, k), 'ASC' if reverse else 'DESC')
+        if use_stats:
+            # command_stats has one row per command already.
+            sc_cl = sc
+        else:
+            # Match each distinct command only once, instead of once
+            # per command_history row.
+            sc_cl = SQLConstructor('command_list AS CL', ['CL.id'])
+        sc_cl.add_matches(glob, 'CL.command',
+                          match_pattern, include_pattern, exclude_pattern)
+        if command_ids is None:
+            cls._add_regexp_prefilter(sc_cl, match_regexp, include_regexp,
+                                      ignore_case)
+            sc_cl.add_matches(regexp, 'CL.command',
+                              match_regexp, include_regexp, exclude_regexp)
+            if not ignore_case:
+                cls._add_prefix_ranges(sc_cl, regexp_literal_prefix,
+                                       match_regexp, include_regexp)
+        else:
+            # Regexps are matched by _match_regexp_in_pool already.
+            # The IDs are inlined as there may be more of them than
+            # the maximum number of parameters.
+            sc_cl.add_condition('CL.id IN ({0})'.format(
+                ', '.join('{0:d}'.format(i) for i in command_ids)))
+        if not ignore_case:
+            cls._add_prefix_ranges(sc_cl, glob_literal_prefix,
+                                   match_pattern, include_pattern)
+        # command_stats is already small enough to scan.  Reading top
+        # rows via its index is faster than using the full-text index
+        # unless the pattern is very rare.
+        if use_fts and not use_stats:
+            cls._add_fts_prefilter(sc_cl, match_pattern, include_pattern)
+        if sc_cl is not sc and sc_cl.conditions:
+            sc.add_in_subquery('command_id', sc_cl)
         sc.add_or_matches(glob, 'DL.directory', cwd_glob)
         sc.add_or_matches(
             eq, 'DL.directory',
             [normalize_directory(os.path.abspath(p)) for p in cwd])
-        sc.add_and_matches('DATETIME({0}) >= {1}', 'start_time', time_after)
-        sc.add_and_matches('DATETIME({0}) <= {1}', 'start_time', time_before)
-        comdura = (
-            '(JULIANDAY(stop_time) - JULIANDAY(start_time)) * 60 * 60 * 24')
-        sc.add_and_matches('({0} >= {1})', comdura, duration_longer_than)
-        sc.add_and_matches('({0} <= {1})', comdura, duration_less_than)
+        # Compare integer columns so that their indexes are used.
+        sc.add_and_matches(lambda c, q: '{0} >= {1}'.format(c, sql_epoch(q)),
+                           'start_ts', time_after)
+        sc.add_and_matches(lambda c, q: '{0} <= {1}'.format(c, sql_epoch(q)),
+                           'start_ts', time_before)
+        sc.add_and_matches('{0} >= {1}', 'duration', duration_longer_than)
+        sc.add_and_matches('{0} <= {1}', 'duration', duration_less_than)
         sc.add_matches(eq, 'exit_code',
                        [], include_exit_code, exclude_exit_code)
         sc.add_matches(eq, 'session_id', [],
@@ -502,14 +1373,23 @@ class DataBase(object):
             match_environ_regexp, include_environ_regexp,
             exclude_environ_regexp)
 
-        if unique:
+        if unique and not use_stats:
             sc.uniquify_by('CL.command', 'start_time')
 
         additional_column_set = set(sort_by) | set(additional_columns)
         need = lambda *x: set(x) & additional_column_set
-        if need('command_count'):
+        if use_stats:
+            if need('command_count'):
+                sc.add_column('CS.count AS command_count', 'command_count')
+            if need('success_count', 'success_ratio'):
+                sc.add_column('CS.success_count AS success_count',
+                              'success_count')
+                sc.add_column(
+                    '(CS.success_count * 1.0 / CS.count) AS success_ratio',
+                    'success_ratio')
+        elif need('command_count'):
             sc.add_column('COUNT(*) as command_count', 'command_count')
-        if need('success_count', 'success_ratio'):
+        if not use_stats and need('success_count', 'success_ratio'):
             sc.join(cls._sc_success_count(),
                     on='command_id = success_command.id')
             sc.add_column('success_count')
@@ -517,7 +1397,7 @@ class DataBase(object):
                           'success_ratio')
         if need('program_count'):
             sc.join(cls._sc_program_count(),
-                    on='PROGRAM_NAME(CL.command) = command_program.program')
+                    on='CL.program_name = command_program.program')
             sc.add_column('program_count')
         if need('session_start_time', 'session_stop_time'):
             sc_sh = SQLConstructor(
@@ -530,11 +1410,78 @@ class DataBase(object):
             sc.add_column('session_start_time', 'session_start')
             sc.add_column('session_stop_time', 'session_stop')
 
-        if condition_as_column:
-            sc.move_where_clause_to_column()
+        if history_ids is not None:
+            sc.add_condition('command_history.id IN ({0})'.format(
+                ', '.join('{0:d}'.format(i) for i in history_ids)))
 
         return sc.compile()
 
+    @staticmethod
+    def _add_prefix_ranges(sc, get_prefix, match_params, include_params):
+        """
+        Add range conditions on the literal prefixes of patterns.
+
+        They are redundant with the pattern matches, but let SQLite
+        scan the range of the index on command_list.command instead
+        of all commands.
+
+        """
+        def ranges(params):
+            for p in params:
+                prefix = get_prefix(p)
+                upper = prefix_upper_bound(prefix)
+                if upper is not None:
+                    yield (prefix, upper)
+
+        between = '({0} >= {1} AND {0} < {2})'
+        sc.add_and_matches(between, 'CL.command',
+                           list(ranges(match_params)), numq=2)
+        include_ranges = list(ranges(include_params))
+        if include_ranges and len(include_ranges) == len(include_params):
+            sc.add_or_matches(between, 'CL.command', include_ranges, numq=2)
+
+    @staticmethod
+    def _add_regexp_prefilter(sc, match_regexp, include_regexp, ignore_case):
+        """
+        Add ``instr`` conditions on the literals the regexps require.
+
+        They are added before the REGEXP conditions, so that most
+        commands are rejected without calling back Python.
+
+        """
+        if ignore_case:
+            instr = 'instr(lower({0}), lower({1}))'
+
+            def literals(pattern):
+                return [part for lit in regexp_required_literals(pattern)
+                        for part in ascii_case_foldable_parts(lit)]
+        else:
+            instr = 'instr({0}, {1})'
+            literals = regexp_required_literals
+
+        sc.add_and_matches(instr, 'CL.command',
+                           [lit for p in match_regexp for lit in literals(p)])
+        longest = [max(literals(p) or [''], key=len) for p in include_regexp]
+        if longest and all(longest):
+            sc.add_or_matches(instr, 'CL.command', longest)
+
+    @staticmethod
+    def _add_fts_prefilter(sc, match_pattern, include_pattern):
+        """
+        Narrow down commands by the full-text index before glob.
+
+        Glob conditions are still checked, as the index only tells
+        which commands include the literal parts of the patterns.
+
+        """
+        fts = ('{0} IN (SELECT rowid FROM command_fts '
+               'WHERE command_fts MATCH {1})')
+        queries = [glob_fts_query(p) for p in match_pattern]
+        sc.add_and_matches(fts, 'CL.id', [q for q in queries if q])
+        queries = [glob_fts_query(p) for p in include_pattern]
+        if queries and all(queries):
+            sc.add_or_matches(fts, 'CL.id', queries)
+
     @classmethod
     def _add_environ_searches(
             cls, sc,
@@ -627,13 +1574,16 @@ class DataBase(object):
 
     @staticmethod
     def _sc_program_count(table_alias='command_program'):
+        # Count per command_id first, which only reads the index on
+        # command_history.command_id, then sum them up per program.
         return SQLConstructor(
-            'command_history '
-            'LEFT JOIN command_list AS CL ON command_id = CL.id',
-            ['PROGRAM_NAME(CL.command) AS program',
-             'COUNT(*) AS program_count'],
+            '(SELECT command_id, COUNT(*) AS command_count '
+            'FROM command_history GROUP BY command_id) AS CC '
+            'JOIN command_list AS CL ON CC.command_id = CL.id',
+            ['CL.program_name AS program',
+             'SUM(CC.command_count) AS program_count'],
             ['program', 'program_count'],
-            group_by=['program'], table_alias=table_alias)
+            group_by=['CL.program_name'], table_alias=table_alias)
 
     @staticmethod
     def _sc_matched_environment_variable(
@@ -0,0 +1,162 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Native recorder (rash init --native-record)
+# This file is sourced after rash.bash and replaces `_rash-record`
+# by a pure-bash implementation of `rash record`.  The following
+# variables are set by `rash init`:
+#
+#   _RASH_RECORD_PATH             `rash locate record` equivalent
+#   _RASH_RECORD_ENVIRON_command  environment variables to record
+#   _RASH_RECORD_OPTS_command     static values given as --environ
+#   _RASH_RECORD_{ENVIRON,OPTS}_exit  (ditto, for exit records)
+
+# printf '%(...)T' needs bash 4.2.  Older bash (e.g., 3.2 on macOS)
+# keeps running `rash record` defined in rash.bash.
+if (( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] < 402 ))
+then
+    return 0
+fi
+
+_RASH_JSON_CONTROLS=()
+_rash-init-json-controls(){
+    local i hex
+    for ((i = 1; i < 32; i++))
+    do
+        printf -v hex '%02x' "$i"
+        printf -v "_RASH_JSON_CONTROLS[$i]" "\\x$hex"
+    done
+}
+_rash-init-json-controls
+
+_rash-json-string(){
+    local s="${1//\\/\\\\}" i hex
+    s="${s//\"/\\\"}"
+    s="${s//$'\n'/\\n}"
+    s="${s//$'\t'/\\t}"
+    s="${s//$'\r'/\\r}"
+    if [[ "$s" == *[[:cntrl:]]* ]]
+    then
+        for i in "${!_RASH_JSON_CONTROLS[@]}"
+        do
+            printf -v hex '\\u%04x' "$i"
+            s="${s//"${_RASH_JSON_CONTROLS[$i]}"/$hex}"
+        done
+    fi
+    REPLY="\"$s\""
+}
+
+_rash-json-int(){
+    case "$1" in
+        ''|-|*[!0-9-]*|?*-*) return 1;;
+    esac
+    REPLY="$1"
+}
+
+_rash-record(){
+    # Usage: _rash-record RECORD_TYPE [OPTIONS]
+    local record_type="$1" json="" key REPLY sep="" environ=""
+    shift
+    local opts="_RASH_RECORD_OPTS_${record_type}[@]"
+    local envkeys="_RASH_RECORD_ENVIRON_${record_type}[@]"
+    local -a pipestatus
+    local has_cwd="" has_stop=""
+    case "$record_type" in
+        command|exit) set -- "$@" "${!opts}";;
+        *) rash record --record-type "$record_type" "$@"; return;;
+    esac
+    while [ $# -gt 0 ]
+    do
+        case "$1" in
+            --session-id|--command|--cwd)
+                key="${1#--}"
+                key="${key//-/_}"
+                [ "$key" = cwd ] && has_cwd=t
+                _rash-json-string "$2"
+                json="$json, \"$key\": $REPLY"
+                shift 2
+                ;;
+            --exit-code|--start|--stop)
+                key="${1#--}"
+                key="${key//-/_}"
+                [ "$key" = stop ] && has_stop=t
+                _rash-json-int "$2" && json="$json, \"$key\": $REPLY"
+                shift 2
+                ;;
+            --environ)
+                _rash-json-string "${2%%=*}"
+                environ="$environ$sep$REPLY: "
+                _rash-json-string "${2#*=}"
+                environ="$environ$REPLY"
+                sep=", "
+                shift 2
+                ;;
+            --pipestatus)
+                shift
+                while [ $# -gt 0 ] && _rash-json-int "$1"
+                do
+                    pipestatus+=("$REPLY")
+                    shift
+                done
+                ;;
+            *)
+                shift
+                ;;
+        esac
+    done
+
+    if [ -z "$has_cwd" ]
+    then
+        _rash-json-string "$PWD"
+        json="$json, \"cwd\": $REPLY"
+    fi
+    if [ -z "$has_stop" ]
+    then
+        printf -v REPLY '%(%s)T' -1
+        json="$json, \"stop\": $REPLY"
+    fi
+    if [ ${#pipestatus[@]} -gt 0 ]
+    then
+        local IFS=,
+        json="$json, \"pipestatus\": [${pipestatus[*]}]"
+        unset IFS
+    fi
+
+    for key in "${!envkeys}"
+    do
+        # Only exported variables, like os.environ in `rash record`:
+        _rash-is-exported "$key" || continue
+        _rash-json-string "$key"
+        environ="$environ$sep$REPLY: "
+        _rash-json-string "${!key}"
+        environ="$environ$REPLY"
+        sep=", "
+    done
+    json="{${json#, }, \"environ\": {$environ}}"
+
+    # Records are partitioned by host and day (see rash/spool.py).
+    local name day dir now
+    printf -v now '%(%s)T' -1
+    printf -v day '%(%Y-%m-%d)T' "$now"
+    printf -v name '%(%Y-%m-%d-%H%M%S)T-%s-%s.json' "$now" "$$" "$RANDOM"
+    dir="$_RASH_RECORD_PATH/$record_type/${HOSTNAME//\//_}/$day"
+
+    # Write to a hidden temporary file then rename it, so that the
+    # indexer never sees a partially written record.
+    [ -d "$dir" ] || mkdir -p "$dir"
+    printf '%s' "$json" > "$dir/.$name.tmp" &&
+        command mv -f "$dir/.$name.tmp" "$dir/$name"
+}
@@ -15,10 +15,86 @@
 
 
 ### Record commands
+_rash-escape-field(){
+    local s="${1//\\/\\\\}"
+    s="${s//$'\t'/\\t}"
+    REPLY="${s//$'\n'/\\n}"
+}
+
+# Usage: _rash-is-exported NAME
+# True if NAME is exported (possibly empty), i.e., it is in the
+# environment of commands.  This runs on every prompt, so avoid the
+# subshell of `declare -p` unless ${NAME@a} (bash 4.4) is missing.
+if (( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] >= 404 ))
+then
+    _rash-is-exported(){
+        [ -n "${!1+set}" ] && [[ "${!1@a}" == *x* ]]
+    }
+else
+    _rash-is-exported(){
+        [ -n "${!1+set}" ] || return 1
+        local decl
+        decl="$(declare -p "$1" 2>/dev/null)"
+        decl="${decl#declare -}"
+        [[ "${decl%% *}" == *x* ]]
+    }
+fi
+
+_rash-record(){
+    # Usage: _rash-record RECORD_TYPE [OPTIONS]
+    # Options and environment variables to record are given by
+    # `rash init` via _RASH_RECORD_{OPTS,ENVIRON}_<RECORD_TYPE>.
+    # <RECORD_TYPE> is not upper-cased, as ${x^^} needs bash 4.
+    local record_type="$1" key arg line="" sep="" REPLY
+    shift
+    local opts="_RASH_RECORD_OPTS_${record_type}[@]"
+    local envkeys="_RASH_RECORD_ENVIRON_${record_type}[@]"
+    local args=(--record-type "$record_type" "$@" "${!opts}")
+    for key in "${!envkeys}"
+    do
+        # Only exported variables, like os.environ in `rash record`:
+        _rash-is-exported "$key" && args+=(--environ "$key=${!key}")
+    done
+
+    # Send a record to the `rash record --serve` coprocess if it is
+    # running.  Otherwise, run `rash record`.
+    if [ -n "$_RASH_RECORD_PID" ] && kill -0 "$_RASH_RECORD_PID" 2>/dev/null
+    then
+        for arg in "${args[@]}"
+        do
+            _rash-escape-field "$arg"
+            line="$line$sep$REPLY"
+            sep=$'\t'
+        done
+        printf '%s\n' "$line" >&"${_RASH_RECORD[1]}" && return
+    fi
+    rash record "${args[@]}"
+}
+
+_rash-start-record-server(){
+    local envkeys
+    { coproc _RASH_RECORD { rash record --serve 2>/dev/null; } } 2>/dev/null
+    # The first line is the list of environment variables, which are
+    # already given by `rash init`.  Use it to check the server is up.
+    if ! read -r -t 5 envkeys <&"${_RASH_RECORD[0]}"
+    then
+        kill "$_RASH_RECORD_PID" 2>/dev/null
+        _RASH_RECORD_PID=""
+    fi
+}
+
+_rash-stop-record-server(){
+    if [ -n "$_RASH_RECORD_PID" ] && [ -n "${_RASH_RECORD[1]}" ]
+    then
+        local pid="$_RASH_RECORD_PID"
+        eval "exec ${_RASH_RECORD[1]}>&-"
+        wait "$pid" 2>/dev/null
+    fi
+}
+
 _rash-postexec(){
     test -d "$PWD" && \
-        rash record \
-        --record-type command \
+        _rash-record command \
         --session-id "$_RASH_SESSION_ID" \
         --command "$_RASH_COMMAND" \
         --cwd "$_RASH_PWD" \
@@ -65,10 +141,16 @@ then
     _RASH_SESSION_ID=$(rash record --record-type init --print-session-id)
 fi
 
+if [ -n "$_RASH_RECORD_SERVE" -a -z "$_RASH_RECORD_PID" ]
+then
+    _rash-start-record-server
+fi
+
 
 ### Record session exit
 _rash-before-exit(){
-    rash record --record-type exit --session-id "$_RASH_SESSION_ID"
+    _rash-record exit --session-id "$_RASH_SESSION_ID"
+    _rash-stop-record-server
 }
 
 trap "_rash-before-exit" EXIT TERM
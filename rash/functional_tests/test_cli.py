@@ -23,9 +23,11 @@ import shutil
 import textwrap
 import json
 import time
+import platform
 
 from ..utils.py3compat import PY3
 from ..config import ConfigStore
+from ..journal import read_journal, is_journal_file
 from ..tests.utils import BaseTestCase, skipIf
 
 BASE_COMMAND = 'rash'
@@ -164,6 +166,17 @@ class ShellTestMixIn(FunctionalTestMixIn):
                 with open(path) as f:
                     data = json.load(f)
                 yield dict(path=path, data=data)
+        for path in self.get_journal_files():
+            for (rectype, data, _) in read_journal(path):
+                if rectype == record_type:
+                    yield dict(path=path, data=data)
+
+    def get_journal_files(self):
+        top = self.cfstore.journal_path
+        if os.path.isdir(top):
+            for f in sorted(os.listdir(top)):
+                if is_journal_file(f):
+                    yield os.path.join(top, f)
 
     def get_all_record_data(self):
         return dict(
@@ -173,10 +186,15 @@ class ShellTestMixIn(FunctionalTestMixIn):
         )
 
     def _get_init_script(self, no_daemon=True, daemon_options=[],
-                        daemon_outfile=None):
+                        daemon_outfile=None, record_serve=False,
+                        native_record=False):
         options = []
         if no_daemon:
             options.append('--no-daemon')
+        if record_serve:
+            options.append('--record-serve')
+        if native_record:
+            options.append('--native-record')
         options.extend(map('--daemon-opt={0}'.format, daemon_options))
         if daemon_outfile:
             options.extend(['--daemon-outfile', daemon_outfile])
@@ -191,6 +209,7 @@ class ShellTestMixIn(FunctionalTestMixIn):
     def test_init(self):
         script = self.get_script("""
         test -n "$_RASH_SESSION_ID" && echo "_RASH_SESSION_ID is defined"
+        echo "_RASH_SESSION_ID=$_RASH_SESSION_ID"
         """)
         (stdout, stderr) = self.run_shell(script)
         self.assertFalse(stderr)
@@ -210,6 +229,8 @@ class ShellTestMixIn(FunctionalTestMixIn):
         assert 'stop' not in data
         self.assertEqual(data['environ']['HOST'], subenv['HOST'])
         init_id = data['session_id']
+        # The session ID is given to the shell by `rash init`:
+        self.assertIn('_RASH_SESSION_ID={0}\n'.format(init_id), stdout)
 
         data = records['exit'][0]['data']
         assert 'start' not in data
@@ -219,6 +240,17 @@ class ShellTestMixIn(FunctionalTestMixIn):
 
         self.assertEqual(init_id, exit_id)
 
+    def test_init_twice(self):
+        # The RC file may be sourced again in the same shell:
+        script = self.get_script(self._get_init_script())
+        (stdout, stderr) = self.run_shell(script)
+        self.assertFalse(stderr)
+        records = self.get_all_record_data()
+        self.assertEqual(len(records['init']), 1)
+        self.assertEqual(len(records['exit']), 1)
+        self.assertEqual(records['init'][0]['data']['session_id'],
+                         records['exit'][0]['data']['session_id'])
+
     def test_postexec(self):
         script = self.get_script(self.test_postexec_script)
         (stdout, stderr) = self.run_shell(script)
@@ -247,6 +279,84 @@ class ShellTestMixIn(FunctionalTestMixIn):
     test_postexec_script = None
     """Set this to a shell script for :meth:`test_postexc`."""
 
+    def test_postexec_record_serve(self):
+        script = self.get_script(self.test_postexec_record_serve_script,
+                                 record_serve=True)
+        (stdout, stderr) = self.run_shell(script)
+
+        # stderr may have some errors in it
+        if stderr:
+            print("Got STDERR from {0} (but it's OK to ignore it)"
+                  .format(self.shell))
+            print(stderr)
+        self.assertIn('_RASH_RECORD_PID is defined', stdout)
+
+        if not self.shell.endswith('bash'):
+            # zsh does not wait for the coprocess on exit.
+            time.sleep(1)
+
+        records = self.get_all_record_data()
+        self.assertEqual(len(records['init']), 1)
+        self.assertEqual(len(records['exit']), 1)
+        self.assertEqual(len(records['command']), 1)
+
+        init_data = records['init'][0]['data']
+        command_data = records['command'][0]['data']
+        assert command_data['session_id'] == init_data['session_id']
+        self.assertEqual(command_data['command'], 'echo "a\tb"\necho \\c')
+        assert command_data['environ']['PATH']
+
+    test_postexec_record_serve_script = r"""
+    test -n "$_RASH_RECORD_PID" && echo "_RASH_RECORD_PID is defined"
+    _RASH_COMMAND=$'echo "a\tb"\necho \\c'
+    _RASH_PWD="$PWD"
+    _RASH_EXIT_CODE=0
+    _RASH_PIPESTATUS=(0)
+    _rash-postexec
+    """
+
+    def test_postexec_native_record(self):
+        script = self.get_script(self.test_postexec_native_record_script,
+                                 native_record=True)
+        (stdout, stderr) = self.run_shell(script)
+
+        # stderr may have some errors in it
+        if stderr:
+            print("Got STDERR from {0} (but it's OK to ignore it)"
+                  .format(self.shell))
+            print(stderr)
+
+        records = self.get_all_record_data()
+        self.assertEqual(len(records['init']), 1)
+        self.assertEqual(len(records['exit']), 1)
+        self.assertEqual(len(records['command']), 1)
+        for rec in records['command'] + records['exit']:
+            assert rec['path'].endswith('.json')
+            relpath = os.path.relpath(rec['path'], self.cfstore.record_path)
+            (_, host, day, _) = relpath.split(os.path.sep)
+            self.assertEqual(host, platform.node())
+            self.assertEqual(len(day), len('YYYY-MM-DD'))
+
+        init_data = records['init'][0]['data']
+        exit_data = records['exit'][0]['data']
+        command_data = records['command'][0]['data']
+        assert command_data['session_id'] == init_data['session_id']
+        assert exit_data['session_id'] == init_data['session_id']
+        self.assertEqual(command_data['command'],
+                         'echo "a\tb"\necho \\c\x01')
+        self.assertEqual(command_data['exit_code'], 1)
+        self.assertEqual(command_data['pipestatus'], [0, 1])
+        assert isinstance(command_data['stop'], int)
+        assert command_data['environ']['PATH']
+
+    test_postexec_native_record_script = r"""
+    _RASH_COMMAND=$'echo "a\tb"\necho \\c\x01'
+    _RASH_PWD="$PWD"
+    _RASH_EXIT_CODE=1
+    _RASH_PIPESTATUS=(0 1)
+    _rash-postexec
+    """
+
     def test_exit_code(self):
         script = self.get_script(self.test_exit_code_script)
         (stdout, stderr) = self.run_shell(script)
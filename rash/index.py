@@ -14,7 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-def index_run(record_path, keep_json, check_duplicate):
+def index_run(record_path, keep_json, check_duplicate, jobs):
     """
     Convert raw JSON records into sqlite3 DB.
 
@@ -25,7 +25,8 @@ def index_run(record_path, keep_json, check_duplicate):
     from .config import ConfigStore
     from .indexer import Indexer
     cfstore = ConfigStore()
-    indexer = Indexer(cfstore, check_duplicate, keep_json, record_path)
+    indexer = Indexer(cfstore, check_duplicate, keep_json, record_path,
+                      jobs=jobs)
     indexer.index_all()
 
 
@@ -43,6 +44,12 @@ def index_add_arguments(parser):
     parser.add_argument(
         '--check-duplicate', default=False, action='store_true',
         help='do not store already existing history in DB.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="""
+        number of processes to read JSON records.  Useful to index
+        many records at once on multi-core machines.
+        """)
 
 
 commands = [
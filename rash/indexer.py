@@ -17,17 +17,83 @@
 import os
 import json
 import warnings
+import threading
+import itertools
+import operator
 
-from .database import DataBase
+from .database import DataBase, normalize_directory, convert_ts
+from .spool import RECORD_TYPES, parse_record_path, iter_record_files
+from .utils.procutils import get_process_context
+from . import journal
+
+
+def load_json_record(json_path):
+    """
+    Load JSON record at `json_path`.  Return None if it is invalid.
+    """
+    with open(json_path) as fp:
+        try:
+            return json.load(fp)
+        except ValueError:
+            warnings.warn(
+                'Ignoring invalid JSON file at: {0}'.format(json_path))
+
+
+def decode_item(item):
+    """
+    Load the record for an item given to :meth:`Indexer.index_batch`.
+
+    ``('record', (json_path, record_type))`` is converted into
+    ``('record', (json_path, record_type, dct))``, where `dct` is
+    None if the file is invalid.  Values are normalized in the same
+    way as :class:`rash.database.DataBase` does when importing, so
+    that this work can be done in worker processes.  Other items are
+    returned as-is.
+
+    """
+    (kind, arg) = item
+    if kind != 'record':
+        return item
+    (json_path, record_type) = arg
+    dct = load_json_record(json_path)
+    if isinstance(dct, dict):
+        for key in ['start', 'stop']:
+            if key in dct:
+                dct[key] = convert_ts(dct[key])
+        if record_type == 'command' and 'cwd' in dct:
+            dct['cwd'] = normalize_directory(dct['cwd'])
+    return (kind, (json_path, record_type, dct))
+
+
+def file_signature(path):
+    """
+    Return ``(path, size, mtime, sha1)`` of the file at `path`.
+    """
+    import hashlib
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return (path, st.st_size, st.st_mtime, sha1)
 
 
 class Indexer(object):
 
     """
-    Translate JSON files into SQLite DB.
+    Translate JSON files and journals into SQLite DB.
+    """
+
+    parallel_threshold = 1000
+    """
+    Minimum number of records to decode them in parallel.
+    """
+
+    chunk_size = 10000
+    """
+    Number of record files imported at once by :meth:`index_all`.
     """
 
-    def __init__(self, cfstore, check_duplicate, keep_json, record_path=None):
+    def __init__(self, cfstore, check_duplicate, keep_json, record_path=None,
+                 jobs=1):
         """
         Create an indexer.
 
@@ -40,6 +106,12 @@ class Indexer(object):
                                Imply ``check_duplicate=True``.
         :type     record_path: str or None
         :arg      record_path: Default to `cfstore.record_path`.
+        :type            jobs: int
+        :arg             jobs: Number of processes to decode records.
+
+        Journals under `cfstore.journal_path` are consumed from the
+        offset saved by the previous run.  When `keep_json` is false,
+        fully consumed journals are truncated.
 
         """
         from .log import logger
@@ -49,23 +121,34 @@ class Indexer(object):
         self.cfstore = cfstore
         self.check_duplicate = check_duplicate
         self.keep_json = keep_json
+        self.jobs = jobs
         self.record_path = record_path or cfstore.record_path
-        self.db = DataBase(cfstore.db_path)
+        self.journal_path = cfstore.journal_path
+        self.db = DataBase(cfstore.db_path,
+                           config=cfstore.get_config().database)
         if record_path:
             self.check_path(record_path, '`record_path`')
 
         self.logger.debug('Indexer initialized')
         self.logger.debug('check_duplicate = %r', self.check_duplicate)
         self.logger.debug('keep_json = %r', self.keep_json)
+        self.logger.debug('jobs = %r', self.jobs)
         self.logger.debug('record_path = %r', self.record_path)
+        self.logger.debug('journal_path = %r', self.journal_path)
 
     def get_record_type(self, path):
-        relpath = os.path.relpath(path, self.cfstore.record_path)
-        dirs = relpath.split(os.path.sep, 1)
-        return dirs[0] if dirs else None
+        """
+        Return the record type of `path` or None if it is not a record.
+
+        See :mod:`rash.spool` for the layout of the record path.
+
+        """
+        parsed = parse_record_path(
+            os.path.relpath(path, self.cfstore.record_path))
+        return parsed and parsed[0]
 
     def check_path(self, path, name='path'):
-        if self.get_record_type(path) not in ['command', 'init', 'exit']:
+        if self.get_record_type(path) not in RECORD_TYPES:
             raise RuntimeError(
                 '{0} must be under {1}'.format(
                     name,
@@ -77,19 +160,135 @@ class Indexer(object):
         """
         Import `json_path` and remove it if :attr:`keep_json` is false.
         """
+        dct = self.load_record(json_path)
+        if dct is None:
+            return
+        self.index_dict(self.get_record_type(json_path), dct)
+        self.remove_record(json_path)
+
+    def load_record(self, json_path):
+        """
+        Load JSON record at `json_path`.  Return None if it is invalid.
+        """
         self.logger.debug('Indexing record: %s', json_path)
         json_path = os.path.abspath(json_path)
         self.check_path(json_path, '`json_path`')
+        return load_json_record(json_path)
+
+    def remove_record(self, json_path):
+        if not self.keep_json:
+            self.logger.info('Removing JSON record: %s', json_path)
+            os.remove(json_path)
+
+    def index_batch(self, items):
+        """
+        Import a batch of records in one transaction.
+
+        :type items: [(str, object)]
+        :arg  items: List of ``('record', json_path)``,
+                     ``('journal', journal_file)`` or
+                     ``('dict', (record_type, dct))``.
 
-        with open(json_path) as fp:
-            try:
-                dct = json.load(fp)
-            except ValueError:
-                warnings.warn(
-                    'Ignoring invalid JSON file at: {0}'.format(json_path))
-                return
+        JSON records are removed after the transaction is committed.
+        Each journal is read once, however many times it is given.
 
-        record_type = self.get_record_type(json_path)
+        """
+        json_paths = set()
+        valid_json_paths = []
+        journal_files = []
+        queue = []
+        for (kind, arg) in items:
+            if kind == 'journal':
+                if arg not in journal_files:
+                    journal_files.append(arg)
+            elif kind == 'record':
+                if arg in json_paths or not os.path.exists(arg):
+                    continue
+                if self.get_record_type(os.path.abspath(arg)) \
+                        not in RECORD_TYPES:
+                    # Do not let a stray file stop the daemon.
+                    self.logger.warning('Ignoring non-record file: %s', arg)
+                    continue
+                json_paths.add(arg)
+                self.logger.debug('Indexing record: %s', arg)
+                queue.append((kind, (arg, self.get_record_type(arg))))
+            else:
+                queue.append((kind, arg))
+
+        def records():
+            for (kind, arg) in self.decode_items(queue):
+                if kind == 'dict':
+                    yield arg
+                    continue
+                (json_path, record_type, dct) = arg
+                if dct is not None:
+                    valid_json_paths.append(json_path)
+                    yield (record_type, dct)
+
+        with self.db.connection(commit=True):
+            self.index_dicts(records())
+            if self.keep_json:
+                self.db.update_indexed_files(
+                    map(file_signature, sorted(json_paths)))
+            for journal_file in journal_files:
+                self.index_journal(journal_file)
+        for json_path in valid_json_paths:
+            self.remove_record(json_path)
+
+    def decode_items(self, items):
+        """
+        Apply :func:`decode_item` to `items`, keeping the order.
+
+        When there are many items and :attr:`jobs` is more than one,
+        the files are read and decoded by a pool of processes while
+        the records are imported by this process.
+
+        """
+        if self.jobs <= 1 or len(items) < self.parallel_threshold:
+            return map(decode_item, items)
+        context = get_process_context()
+        if context is None and threading.active_count() > 1:
+            # Forking a process while other threads (e.g., the
+            # observer of the daemon) may hold locks can deadlock
+            # the child processes.
+            self.logger.debug('Not forking, as other threads are running.')
+            return map(decode_item, items)
+        return self._decode_items_in_pool(items, context)
+
+    def _decode_items_in_pool(self, items, context=None):
+        import multiprocessing
+        self.logger.debug('Decoding %d items by %d processes.',
+                          len(items), self.jobs)
+        pool = (context or multiprocessing).Pool(self.jobs)
+        try:
+            for item in pool.imap(decode_item, items, chunksize=64):
+                yield item
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def index_dicts(self, records):
+        """
+        Import ``(record_type, dct)`` pairs in `records`.
+
+        Consecutive command records are imported in bulk by
+        :meth:`DataBase.import_many`.
+
+        """
+        for (record_type, group) in itertools.groupby(
+                records, key=operator.itemgetter(0)):
+            if record_type == 'command':
+                self.db.import_many((dct for (_, dct) in group),
+                                    check_duplicate=self.check_duplicate)
+            else:
+                for (_, dct) in group:
+                    self.index_dict(record_type, dct)
+
+    def index_dict(self, record_type, dct):
+        """
+        Import a record `dct` of type `record_type`.
+        """
         kwds = {}
         if record_type == 'command':
             importer = self.db.import_dict
@@ -102,24 +301,110 @@ class Indexer(object):
             raise ValueError("Unknown record type: {0}".format(record_type))
         importer(dct, **kwds)
 
-        if not self.keep_json:
-            self.logger.info('Removing JSON record: %s', json_path)
-            os.remove(json_path)
+    def index_journal(self, journal_file):
+        """
+        Import records appended to `journal_file` since the last call.
+        """
+        offset = journal.load_offset(journal_file)
+        self.logger.debug('Indexing journal: %s (offset=%d)',
+                          journal_file, offset)
+        consumed = [offset]
+
+        def records():
+            for (record_type, dct, next_offset) in journal.read_journal(
+                    journal_file, offset):
+                consumed[0] = next_offset
+                yield (record_type, dct)
+
+        with self.db.connection(commit=True) as connection:
+            self.index_dicts(records())
+            # Offset must be saved after the records are committed:
+            connection.commit()
+        offset = consumed[0]
+        journal.save_offset(journal_file, offset)
+
+        if not self.keep_json and journal.truncate_if_consumed(
+                journal_file, offset):
+            self.logger.info('Truncated consumed journal: %s', journal_file)
 
     def find_record_files(self):
         """
         Yield paths to record files.
         """
-        for (root, _, files) in os.walk(self.record_path):
-            for f in (f for f in files if f.endswith('.json')):
-                yield os.path.join(root, f)
+        for (path, _) in self.scan_record_files():
+            yield path
+
+    def scan_record_files(self):
+        """
+        Yield ``(path, stat)`` of record files, partition by partition.
+
+        See :func:`rash.spool.iter_record_files`.
+
+        """
+        return iter_record_files(self.cfstore.record_path, self.record_path)
+
+    def find_new_record_files(self):
+        """
+        Return paths to record files which are not indexed yet.
+
+        See :meth:`iter_new_record_files`.
+
+        """
+        return list(self.iter_new_record_files())
+
+    def iter_new_record_files(self):
+        """
+        Yield paths to record files which are not indexed yet.
+
+        Files already indexed are skipped if their size and mtime are
+        not changed, without reading them.  See also
+        :meth:`DataBase.get_indexed_files`.
+
+        """
+        indexed = self.db.get_indexed_files()
+        touched = []
+        for (path, st) in self.scan_record_files():
+            old = indexed.get(path)
+            if old:
+                if old[:2] == (st.st_size, st.st_mtime):
+                    continue
+                signature = file_signature(path)
+                if signature[3] == old[2]:
+                    # Only mtime is changed.  No need to index.
+                    touched.append(signature)
+                    continue
+            yield path
+        if touched:
+            self.db.update_indexed_files(touched)
+
+    def find_journal_files(self):
+        """
+        Yield paths to journal files.
+        """
+        if not os.path.isdir(self.journal_path):
+            return
+        for f in sorted(os.listdir(self.journal_path)):
+            if journal.is_journal_file(f):
+                yield os.path.join(self.journal_path, f)
 
     def index_all(self):
         """
-        Index all records under :attr:`record_path`.
+        Index all records under :attr:`record_path` and all journals.
         """
         self.logger.debug('Start indexing all records under: %s',
                           self.record_path)
-        with self.db.connection():
-            for json_path in sorted(self.find_record_files()):
-                self.index_record(json_path)
+        if self.keep_json:
+            json_paths = self.iter_new_record_files()
+        else:
+            json_paths = self.find_record_files()
+        # Import record files in chunks, so that memory usage does not
+        # grow with the number of files.
+        items = []
+        for json_path in json_paths:
+            items.append(('record', json_path))
+            if len(items) >= self.chunk_size:
+                self.index_batch(items)
+                items = []
+        items.extend(('journal', journal_file)
+                     for journal_file in self.find_journal_files())
+        self.index_batch(items)
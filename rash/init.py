@@ -15,26 +15,57 @@
 
 
 import os
+import re
 
 
 def shell_name(shell):
     return shell.rsplit(os.path.sep, 1)[-1]
 
 
-def find_init(shell):
+def find_init(shell, name='rash'):
     rash_dir = os.path.dirname(__file__)
-    return os.path.join(rash_dir, 'ext', 'rash.{0}'.format(shell_name(shell)))
+    return os.path.join(rash_dir, 'ext',
+                        '{0}.{1}'.format(name, shell_name(shell)))
+
+
+def shell_quote(string):
+    """
+    Quote `string` for bash and zsh.
+
+    >>> print(shell_quote("it's"))
+    'it'\\''s'
+
+    """
+    return "'{0}'".format(string.replace("'", "'\\''"))
 
 
 INIT_TEMPLATE = """\
-source '{file}'
-_RASH_VERSION='{version}'
+if [ -z "$_RASH_SESSION_ID" ]; then
+_RASH_SESSION_ID={session_id};
+printf '%s' {init_json} > {init_tmp} && command mv -f {init_tmp} {init_file};
+fi;
+{record_variables}_RASH_RECORD_SERVE='{record_serve}';
+source '{file}';
+{native_record}_RASH_VERSION='{version}'
 """
 # Currently `_RASH_VERSION` is not used anywhere, but it is useful to
 # see when RASH for a long lasting shell session is initialized.
+# Note that each line must be terminated by ";" (or be "then") as
+# the output is evaluated as one line by ``eval $(rash init)``.
 
+RECORD_VARIABLES_TEMPLATE = """\
+_RASH_RECORD_ENVIRON_{name}=({environ});
+_RASH_RECORD_OPTS_{name}=({options});
+"""
 
-def init_run(shell, no_daemon, daemon_options, daemon_outfile):
+NATIVE_RECORD_TEMPLATE = """\
+_RASH_RECORD_PATH={record_path};
+source '{file}';
+"""
+
+
+def init_run(shell, no_daemon, daemon_options, daemon_outfile,
+             record_serve, native_record):
     """
     Configure your shell.
 
@@ -61,20 +92,155 @@ def init_run(shell, no_daemon, daemon_options, daemon_outfile):
     To see the other methods to launch the daemon process, see
     ``rash daemon --help``.
 
+    To record commands without starting Python process for each
+    command, use --record-serve option.  It starts one ``rash record
+    --serve`` process per shell session as a coprocess::
+
+      eval $(%(prog)s --record-serve)
+
+    As only one coprocess can exist at the same time in zsh and bash,
+    do not use this option if you are using coprocess for other things.
+
+    To record commands without starting any process, use
+    --native-record option.  Records are written as JSON files by
+    shell functions and then indexed by the daemon::
+
+      eval $(%(prog)s --native-record)
+
     """
     import sys
     from .__init__ import __version__
+    from .config import ConfigStore
+    from .record import make_record, generate_session_id
+    if record_serve and native_record:
+        raise RuntimeError(
+            '--record-serve and --native-record cannot be used together')
     init_file = find_init(shell)
-    if os.path.exists(init_file):
-        sys.stdout.write(INIT_TEMPLATE.format(
-            file=init_file, version=__version__))
-    else:
+    if not os.path.exists(init_file):
         raise RuntimeError(
             "Shell '{0}' is not supported.".format(shell_name(shell)))
 
+    # Make the init record here rather than running `rash record`
+    # from the shell script, to start Python only once.  The shell
+    # writes it only if it is not in a session yet, as the RC file
+    # may be sourced again.
+    cfstore = ConfigStore()
+    config = cfstore.get_config()
+    data = make_record(config, 'init')
+    data['session_id'] = generate_session_id(data)
+    (record_tmp, record_file) = init_record_paths(cfstore, data)
+
+    sys.stdout.write(INIT_TEMPLATE.format(
+        file=init_file, version=__version__,
+        session_id=shell_quote(data['session_id']),
+        init_json=shell_quote(json_for_eval(data)),
+        init_tmp=shell_quote(record_tmp),
+        init_file=shell_quote(record_file),
+        record_variables=record_variables_script(config, data['environ']),
+        record_serve='t' if record_serve else '',
+        native_record=native_record_script(shell, cfstore) if native_record
+        else ''))
+
     if not no_daemon:
-        from .daemon import start_daemon_in_subprocess
-        start_daemon_in_subprocess(daemon_options, daemon_outfile)
+        from .daemon import is_daemon_alive, start_daemon_in_subprocess
+        # Check it here, as starting a daemon process only to find
+        # the running one is slow when many shells start at once.
+        if '--restart' in daemon_options or not is_daemon_alive(cfstore):
+            start_daemon_in_subprocess(daemon_options, daemon_outfile)
+
+
+def init_record_paths(cfstore, data):
+    """
+    Return the temporary path and the path to write the init record
+    `data` to.  Its directory is created here.
+
+    Like the native recorder, the shell writes the record to the
+    temporary path and then renames it, so that the indexer never
+    sees a partially written record.
+
+    """
+    import time
+    from .spool import get_partition_path
+    from .utils.pathutils import mkdirp
+    directory = get_partition_path(cfstore.record_path, 'init',
+                                   ts=data['start'])
+    mkdirp(directory)
+    name = '{0}-{1}.json'.format(
+        time.strftime('%Y-%m-%d-%H%M%S', time.localtime(data['start'])),
+        os.getppid())
+    return (os.path.join(directory, '.' + name + '.tmp'),
+            os.path.join(directory, name))
+
+
+def json_for_eval(data):
+    r"""
+    Encode `data` to JSON which survives ``eval $(rash init)``.
+
+    The output of command substitution is split into words and then
+    joined by a space, and each word is subject to pathname
+    expansion.  So whitespace and glob characters are escaped.  As
+    compact JSON has them only in strings when `data` has no list,
+    `data` must not have a list.
+
+    >>> print(json_for_eval({'cwd': '/a  b/*'}))
+    {"cwd":"/a\u0020\u0020b/\u002a"}
+
+    """
+    import json
+    return re.sub(
+        r'[\s*?\[\]]', lambda m: '\\u{0:04x}'.format(ord(m.group())),
+        json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+
+def record_variables_script(config, init_environ):
+    """
+    Generate shell script to set variables used by `_rash-record`.
+
+    The values of the environment variables which do not change
+    during the shell session are computed here only once and passed
+    to `rash record` as --environ options.  Other variables are
+    listed in ``_RASH_RECORD_ENVIRON_{command,exit}`` and looked up
+    by the shell for each record.
+
+    :type         config: rash.config.Configuration
+    :type   init_environ: dict
+    :arg    init_environ: Environment variables in the init record.
+                          These are reused for static values.
+
+    """
+    from .record import STATIC_ENVIRON_KEYS, get_environ
+    envkeys = dict((t, config.record.environ[t]) for t in ['command', 'exit'])
+    static_keys = [k for k in STATIC_ENVIRON_KEYS
+                   if any(k in keys for keys in envkeys.values())]
+    static = dict((k, init_environ[k]) for k in static_keys
+                  if k in init_environ)
+    static.update(get_environ([k for k in static_keys if k not in static]))
+
+    script = []
+    for (record_type, keys) in sorted(envkeys.items()):
+        options = ['--no-config'] + [
+            '--environ ' + shell_quote('{0}={1}'.format(k, static[k]))
+            for k in keys if k in static]
+        script.append(RECORD_VARIABLES_TEMPLATE.format(
+            name=record_type,
+            environ=' '.join(shell_quote(k) for k in keys
+                             if k not in static_keys),
+            options=' '.join(options)))
+    return ''.join(script)
+
+
+def native_record_script(shell, cfstore):
+    """
+    Generate shell script to load the native recorder for `shell`.
+    """
+    init_file = find_init(shell, 'native')
+    if not os.path.exists(init_file):
+        raise RuntimeError(
+            "Shell '{0}' does not support --native-record."
+            .format(shell_name(shell)))
+    return NATIVE_RECORD_TEMPLATE.format(
+        file=init_file,
+        record_path=shell_quote(cfstore.record_path))
 
 
 def init_add_arguments(parser):
@@ -97,6 +263,20 @@ def init_add_arguments(parser):
         available options.  It can be specified many times.
         Note that --no-error is always passed to the daemon command.
         """)
+    parser.add_argument(
+        '--record-serve', action='store_true', default=False,
+        help="""
+        Record commands via a `rash record --serve` coprocess started
+        once per shell session, instead of running `rash record` for
+        each command.
+        """)
+    parser.add_argument(
+        '--native-record', action='store_true', default=False,
+        help="""
+        Record commands by shell functions writing JSON files,
+        instead of running `rash record` for each command.
+        Bash older than 4.2 keeps running `rash record`.
+        """)
     parser.add_argument(
         '--daemon-outfile', default=os.devnull,
         help="""
@@ -24,6 +24,7 @@ except ImportError:
     # Dummy class for making this module importable:
     FinderMultiQueryString = object
 
+from .database import QueryHandle
 from .search import search_add_arguments
 from .query import SafeArgumentParser, expand_query, preprocess_kwds
 
@@ -61,10 +62,13 @@ class RashFinder(FinderMultiQueryString):
         self.__parser = parser = SafeArgumentParser()
         search_add_arguments(parser)
 
-    # Generator should be terminated in order to close connection to
-    # sqlite.  Otherwise, sqlite3 modules raise an error saying that
-    # it doesn't support multi-threading access.
-    lazy_finding = False
+    # Records are fetched from DB only when percol needs them.  The
+    # search generator can be consumed in any thread, as DataBase
+    # opens a connection per thread.
+    lazy_finding = True
+
+    _records = None
+    _handle = None
 
     and_search = False
 
@@ -77,12 +81,13 @@ class RashFinder(FinderMultiQueryString):
         except (ValueError, SyntaxError):
             return super(RashFinder, self).find(query, collection)
 
-        # SOMEDAY: get rid of this hard-coded search limit by making
-        # `search_command_record` thread-safe and setting
-        # `lazy_finding = True`.
-        kwds['limit'] = 50 if kwds['match_pattern'] else 1000
+        # No need to limit the search, as records are fetched lazily.
+        kwds['limit'] = -1
 
-        records = self.db.search_command_record(**kwds)
+        self.close_records()
+        self._handle = handle = QueryHandle()
+        self._records = records = self.db.search_command_record(
+            handle=handle, **kwds)
         self.collection = collection = (r.command for r in records)
 
         # There will be no filtering in the super class.
@@ -93,6 +98,25 @@ class RashFinder(FinderMultiQueryString):
         return super(RashFinder, self).find(subquery, collection)
 
 
+    def close_records(self):
+        """
+        Stop the previous search and close its connection.
+        """
+        records = self._records
+        self._records = None
+        if records is None:
+            return
+        close = getattr(records, 'close', None)
+        if close is None:
+            # Not a generator (e.g., islice); closed when collected.
+            return
+        try:
+            close()
+        except ValueError:
+            # It is being consumed by other thread.
+            self._handle.interrupt()
+
+
 def load_rc(percol, path=None, encoding=None):
     import os
     from percol import debug
@@ -117,7 +141,8 @@ def launch_isearch(cfstore, rcfile=None, input_encoding=None,
     default = lambda val, defv: defv if val is None else val
 
     # Pass db instance to finder.  Not clean but works and no harm.
-    RashFinder.db = DataBase(cfstore.db_path)
+    RashFinder.db = DataBase(cfstore.db_path, readonly=True,
+                             config=config.database)
     RashFinder.base_query = default(base_query, config.isearch.base_query)
     RashFinder.rashconfig = config
 
@@ -0,0 +1,279 @@
+"""
+Append-only record journal.
+
+Shell sessions append records to a journal file instead of creating
+one JSON file per command.  Each record is stored as a
+length-prefixed frame::
+
+  <length>\\n<payload>\\n
+
+where ``<payload>`` is a UTF-8 encoded JSON array
+``[record_type, data]`` and ``<length>`` is its size in bytes.  A
+frame is written by a single :func:`os.write` call while holding an
+exclusive :func:`fcntl.flock` on the journal, so concurrent shells
+never interleave their records.
+
+The indexer remembers how far it has consumed each journal in a
+small ``<journal>.offset`` file next to it, so that it only ever
+reads the records appended since the last run.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import json
+import warnings
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .utils.pathutils import mkdirp
+
+JOURNAL_SUFFIX = '.journal'
+OFFSET_SUFFIX = '.offset'
+
+
+def get_journal_file(journal_path, host=None):
+    """
+    Return the path to the journal of `host` under `journal_path`.
+
+    >>> get_journal_file('journal', 'myhost') == os.path.join(
+    ...     'journal', 'myhost.journal')
+    True
+
+    """
+    if host is None:
+        import platform
+        host = platform.node()
+    return os.path.join(journal_path, host + JOURNAL_SUFFIX)
+
+
+def is_journal_file(path):
+    return path.endswith(JOURNAL_SUFFIX)
+
+
+def encode_record(record_type, data):
+    """
+    Encode a record into a payload.
+
+    >>> decode_record(encode_record('command', {'command': 'ls'}))
+    ('command', {'command': 'ls'})
+
+    """
+    return json.dumps([record_type, data]).encode('utf-8')
+
+
+def decode_record(payload):
+    (record_type, data) = json.loads(payload.decode('utf-8'))
+    return (record_type, data)
+
+
+def encode_frame(payload):
+    """
+    Wrap `payload` by the length-prefixed frame.
+
+    >>> encode_frame(b'[]') == b'2\\n[]\\n'
+    True
+
+    """
+    return str(len(payload)).encode('ascii') + b'\n' + payload + b'\n'
+
+
+@contextmanager
+def locked(fd):
+    """
+    Hold an exclusive lock on file descriptor `fd`.
+    """
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield fd
+    finally:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def append_record(journal_file, record_type, data):
+    """
+    Append a record to `journal_file` atomically.
+    """
+    mkdirp(os.path.dirname(journal_file))
+    frame = encode_frame(encode_record(record_type, data))
+    fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        with locked(fd):
+            while frame:
+                frame = frame[os.write(fd, frame):]
+    finally:
+        os.close(fd)
+
+
+_HEADER_RE = re.compile(b'[0-9]+\n')
+_RESYNC_CHUNK_SIZE = 64 * 1024
+
+
+def _read_frame(fp, offset):
+    """
+    Read the frame at `offset` of `fp`.
+
+    Return ``(status, payload, next_offset)`` where `status` is
+    ``'ok'``, ``'incomplete'`` (the frame may still be being written)
+    or ``'broken'`` (the header or the terminator is wrong).
+
+    """
+    fp.seek(offset)
+    header = fp.readline()
+    if not header.endswith(b'\n'):
+        return ('incomplete', None, offset)
+    try:
+        length = int(header)
+    except ValueError:
+        return ('broken', None, offset)
+    payload = fp.read(length + 1)
+    if len(payload) < length + 1:
+        return ('incomplete', None, offset)
+    if not payload.endswith(b'\n'):
+        return ('broken', None, offset)
+    return ('ok', payload[:length], offset + len(header) + length + 1)
+
+
+def _find_frame(fp, offset):
+    """
+    Return the offset of the first valid frame after `offset`, or None
+    if there is no complete frame with a decodable payload.
+    """
+    # A header may start anywhere, as the broken frame may lack the
+    # terminator.  Chunks overlap so that no header is split.
+    overlap = 32
+    start = offset + 1
+    while True:
+        fp.seek(start)
+        chunk = fp.read(_RESYNC_CHUNK_SIZE)
+        if not chunk:
+            return None
+        for match in _HEADER_RE.finditer(chunk):
+            # The digits before may be garbage: try every suffix.
+            for i in range(match.start(), match.end() - 1):
+                (status, payload, _) = _read_frame(fp, start + i)
+                if status == 'ok':
+                    try:
+                        decode_record(payload)
+                    except (TypeError, ValueError):
+                        continue
+                    return start + i
+        if len(chunk) < _RESYNC_CHUNK_SIZE:
+            return None
+        start += len(chunk) - overlap
+
+
+def read_journal(journal_file, offset=0):
+    """
+    Yield ``(record_type, data, next_offset)`` stored after `offset`.
+
+    Reading stops at the first incomplete frame, which is a record
+    being written at this moment.  It will be read next time, starting
+    from the last `next_offset` yielded.  Frames with broken payload
+    are skipped with a warning.  A broken or incomplete frame followed
+    by a valid one (e.g., a torn write) is skipped with a warning, too.
+
+    """
+    with open(journal_file, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        if offset > fp.tell():
+            # The journal is truncated after `offset` was saved.
+            offset = 0
+        while True:
+            (status, payload, next_offset) = _read_frame(fp, offset)
+            if status != 'ok':
+                # An incomplete frame followed by a valid one is a torn
+                # write, as records are appended one by one under lock.
+                # JSON payloads have no newline, so a frame is never
+                # found inside the one being written.
+                found = _find_frame(fp, offset)
+                if found is None:
+                    return
+                warnings.warn(
+                    'Skipping broken frame at {0} (up to {1}) in journal: '
+                    '{2}'.format(offset, found, journal_file))
+                offset = found
+                continue
+            try:
+                (record_type, data) = decode_record(payload)
+            except (TypeError, ValueError):
+                warnings.warn(
+                    'Ignoring invalid record at {0} in journal: {1}'
+                    .format(offset, journal_file))
+                offset = next_offset
+                continue
+            offset = next_offset
+            yield (record_type, data, offset)
+
+
+def get_offset_file(journal_file):
+    return journal_file + OFFSET_SUFFIX
+
+
+def load_offset(journal_file):
+    """
+    Load the consumed byte offset of `journal_file` (0 if unknown).
+    """
+    try:
+        with open(get_offset_file(journal_file)) as fp:
+            return int(fp.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def save_offset(journal_file, offset):
+    """
+    Atomically persist the consumed byte offset of `journal_file`.
+    """
+    offset_file = get_offset_file(journal_file)
+    tmp_file = offset_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        fp.write(str(offset))
+    os.rename(tmp_file, offset_file)
+
+
+def truncate_if_consumed(journal_file, offset):
+    """
+    Empty `journal_file` if all records up to its end are consumed.
+
+    The check and the truncation happen under the same lock used by
+    :func:`append_record`, so no record can be lost.  The offset is
+    reset before truncation; a crash in between results in
+    re-reading the journal rather than skipping new records.
+
+    :rtype: bool
+    :return: True if truncated.
+
+    """
+    fd = os.open(journal_file, os.O_WRONLY)
+    try:
+        with locked(fd):
+            if os.fstat(fd).st_size != offset:
+                return False
+            save_offset(journal_file, 0)
+            os.ftruncate(fd, 0)
+            return True
+    finally:
+        os.close(fd)
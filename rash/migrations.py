@@ -0,0 +1,368 @@
+"""
+Schema migrations.
+
+``schema.sql`` creates the tables of the first schema.  Changes made
+after that are listed in :data:`MIGRATIONS` and applied in order by
+:func:`migrate`, both to new and to existing databases.  The number of
+applied migrations is stored in ``PRAGMA user_version``.
+
+Each migration runs in its own transaction, so a database is never
+left half-migrated.  Migrations which cannot run in a transaction
+(e.g., changing the journal mode) set ``transactional = False``.
+
+To change the schema, append a new function to :data:`MIGRATIONS`;
+never edit or reorder the existing ones.  Migrations should be
+idempotent, as databases created before this module existed may
+already have some of the changes.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sqlite3
+import warnings
+
+
+def get_columns(db, table):
+    return [row[1] for row in db.execute(
+        'PRAGMA table_info("{0}")'.format(table))]
+
+
+def add_fingerprint_column(db):
+    """
+    Add command_history.fingerprint.
+
+    See :meth:`rash.database.DataBase.select_by_command_record`.
+
+    """
+    from .database import sql_command_fingerprint_func
+    if 'fingerprint' not in get_columns(db, 'command_history'):
+        db.execute('ALTER TABLE command_history ADD COLUMN fingerprint TEXT')
+        # Computed inside SQLite, not to load the whole history.
+        db.create_function('COMMAND_FINGERPRINT', 6,
+                           sql_command_fingerprint_func)
+        db.execute(
+            '''
+            UPDATE command_history SET fingerprint = COMMAND_FINGERPRINT(
+                (SELECT command FROM command_list
+                 WHERE id = command_id),
+                (SELECT directory FROM directory_list
+                 WHERE id = directory_id),
+                (SELECT terminal FROM terminal_list
+                 WHERE id = terminal_id),
+                start_time, stop_time, exit_code)
+            ''')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS command_history_fingerprint '
+        'ON command_history (fingerprint)')
+
+
+def add_indexed_file_table(db):
+    """
+    Add indexed_file table to remember JSON records already indexed.
+
+    It is used when the records are kept (rash index --keep-json) to
+    skip them next time.
+
+    """
+    db.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS indexed_file (
+          path TEXT PRIMARY KEY,
+          size INTEGER NOT NULL,
+          mtime REAL NOT NULL,
+          sha1 TEXT NOT NULL
+        )
+        ''')
+
+
+def add_secondary_indexes(db):
+    """
+    Add indexes on the columns used for joining and sorting.
+    """
+    for (table, columns) in [
+            ('command_history', ['command_id']),
+            ('command_history', ['session_id', 'start_time']),
+            ('command_history', ['directory_id']),
+            ('command_history', ['start_time']),
+            ('command_environment_map', ['ch_id']),
+            ('session_environment_map', ['sh_id']),
+            ('pipe_status_map', ['ch_id'])]:
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({2})'.format(
+                table, '_'.join(columns), ', '.join(columns)))
+
+
+def make_environment_variable_unique(db):
+    """
+    Merge duplicated environment variables and make them unique.
+
+    References from command_environment_map and
+    session_environment_map are moved to the smallest ID.
+
+    """
+    db.execute(
+        '''
+        CREATE TEMP TABLE duplicated_environment_variable AS
+        SELECT EV.id AS id, canonical.id AS canonical_id
+        FROM environment_variable AS EV
+        JOIN (
+            SELECT variable_name, variable_value, MIN(id) AS id
+            FROM environment_variable
+            GROUP BY variable_name, variable_value
+            HAVING COUNT(*) > 1
+        ) AS canonical
+        ON EV.variable_name = canonical.variable_name AND
+           EV.variable_value = canonical.variable_value AND
+           EV.id != canonical.id
+        ''')
+    for table in ['command_environment_map', 'session_environment_map']:
+        db.execute(
+            '''
+            UPDATE {0} SET ev_id = (
+                SELECT canonical_id FROM duplicated_environment_variable
+                WHERE id = {0}.ev_id)
+            WHERE ev_id IN (SELECT id FROM duplicated_environment_variable)
+            '''.format(table))
+    db.execute(
+        'DELETE FROM environment_variable '
+        'WHERE id IN (SELECT id FROM duplicated_environment_variable)')
+    db.execute('DROP TABLE duplicated_environment_variable')
+    db.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS environment_variable_name_value '
+        'ON environment_variable (variable_name, variable_value)')
+
+
+def enable_wal(db):
+    """
+    Use write-ahead logging, so that searches do not block indexing.
+
+    The journal mode is persistent and cannot be changed in a
+    transaction.
+
+    """
+    db.execute('PRAGMA journal_mode = WAL')
+enable_wal.transactional = False
+
+
+def add_program_name_column(db):
+    """
+    Add command_list.program_name, computed by
+    :func:`rash.database.sql_program_name_func` when inserted.
+    """
+    from .database import sql_program_name_func
+    if 'program_name' not in get_columns(db, 'command_list'):
+        db.execute('ALTER TABLE command_list ADD COLUMN program_name TEXT')
+        db.create_function('PROGRAM_NAME', 1, sql_program_name_func)
+        db.execute('UPDATE command_list SET program_name = '
+                   'PROGRAM_NAME(command)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS command_list_program_name '
+        'ON command_list (program_name)')
+
+
+def add_command_stats_table(db):
+    """
+    Add command_stats table which aggregates command_history per
+    command.  It is updated by a trigger whenever a command is
+    inserted, i.e., in the same transaction as the importer.
+
+    See :meth:`rash.database.DataBase._compile_sql_search_command_record`.
+
+    """
+    duration = ('IFNULL((JULIANDAY({0}stop_time) - JULIANDAY({0}start_time))'
+                ' * 60 * 60 * 24, 0)').format
+    db.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS command_stats (
+          -- 0 for command records without command
+          command_id INTEGER PRIMARY KEY,
+          count INTEGER NOT NULL,
+          success_count INTEGER NOT NULL,
+          first_start TIMESTAMP,
+          last_start TIMESTAMP,
+          -- command_history.id of the last command
+          last_id INTEGER,
+          -- in seconds
+          total_duration REAL NOT NULL,
+          FOREIGN KEY(command_id) REFERENCES command_list(id),
+          FOREIGN KEY(last_id) REFERENCES command_history(id)
+        )
+        ''')
+    db.execute('DELETE FROM command_stats')
+    db.execute(
+        '''
+        INSERT INTO command_stats
+        SELECT
+          IFNULL(command_id, 0),
+          COUNT(*),
+          COUNT(CASE WHEN exit_code = 0 THEN 1 ELSE NULL END),
+          MIN(start_time),
+          MAX(start_time),
+          (SELECT id FROM command_history AS LAST
+           WHERE LAST.command_id IS CH.command_id
+           ORDER BY start_time DESC, id DESC LIMIT 1),
+          TOTAL({0})
+        FROM command_history AS CH
+        GROUP BY command_id
+        '''.format(duration('')))
+    for column in ['count', 'success_count', 'last_start']:
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS command_stats_{0} '
+            'ON command_stats ({0})'.format(column))
+    db.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS update_command_stats
+        AFTER INSERT ON command_history
+        FOR EACH ROW
+        BEGIN
+          INSERT OR IGNORE INTO command_stats
+            (command_id, count, success_count, total_duration)
+            VALUES (IFNULL(NEW.command_id, 0), 0, 0, 0);
+          UPDATE command_stats SET
+            count = count + 1,
+            success_count = success_count +
+              (CASE WHEN NEW.exit_code = 0 THEN 1 ELSE 0 END),
+            first_start = CASE
+              WHEN first_start IS NULL OR NEW.start_time < first_start
+              THEN NEW.start_time ELSE first_start END,
+            last_id = CASE
+              WHEN last_start IS NULL OR NEW.start_time >= last_start
+              THEN NEW.id ELSE last_id END,
+            last_start = CASE
+              WHEN last_start IS NULL OR NEW.start_time >= last_start
+              THEN NEW.start_time ELSE last_start END,
+            total_duration = total_duration + {0}
+          WHERE command_id = IFNULL(NEW.command_id, 0);
+        END
+        '''.format(duration('NEW.')))
+
+
+def add_command_fts(db):
+    """
+    Add full-text index command_fts of command_list, if the SQLite
+    library supports FTS5 with trigram tokenizer.
+
+    It is used to narrow down commands before matching glob patterns.
+    See :meth:`rash.database.DataBase.sync_command_fts`.
+
+    """
+    from .log import logger
+    try:
+        db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS command_fts "
+            "USING fts5(command, tokenize='trigram')")
+    except sqlite3.OperationalError as err:
+        logger.info('Full-text search is not available: %s', err)
+        return
+    db.execute('DELETE FROM command_fts')
+    db.execute('INSERT INTO command_fts (rowid, command) '
+               'SELECT id, command FROM command_list')
+
+
+def add_epoch_columns(db):
+    """
+    Add command_history.start_ts, stop_ts and duration in seconds,
+    so that time and duration conditions are done by index.
+
+    See :meth:`rash.database.DataBase._sql_insert_command_history`.
+
+    """
+    from .database import sql_epoch
+    columns = get_columns(db, 'command_history')
+    for column in ['start_ts', 'stop_ts', 'duration']:
+        if column not in columns:
+            db.execute('ALTER TABLE command_history '
+                       'ADD COLUMN {0} INTEGER'.format(column))
+    db.execute(
+        'UPDATE command_history SET start_ts = {0}, stop_ts = {1}'
+        .format(sql_epoch('start_time'), sql_epoch('stop_time')))
+    db.execute('UPDATE command_history SET duration = stop_ts - start_ts')
+    for column in ['start_ts', 'duration']:
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS command_history_{0} '
+            'ON command_history ({0})'.format(column))
+
+
+MIGRATIONS = [
+    add_fingerprint_column,
+    add_indexed_file_table,
+    add_secondary_indexes,
+    make_environment_variable_unique,
+    enable_wal,
+    add_program_name_column,
+    add_command_stats_table,
+    add_command_fts,
+    add_epoch_columns,
+]
+"""
+Migrations in the order to be applied.  ``PRAGMA user_version`` is the
+number of the migrations already applied.
+"""
+
+
+def get_user_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db, migrations=MIGRATIONS):
+    """
+    Apply `migrations` not yet applied to the connection `db`.
+
+    Return the number of the applied migrations.
+
+    """
+    from .log import logger
+    isolation_level = db.isolation_level
+    # Manage transactions explicitly, as the sqlite3 module may
+    # commit implicitly before DDL statements.
+    db.isolation_level = None
+    applied = 0
+    try:
+        for (i, migration) in enumerate(migrations):
+            if get_user_version(db) > i:
+                continue
+            transactional = getattr(migration, 'transactional', True)
+            if not transactional:
+                # It must be idempotent, as other process may run it
+                # at the same time.
+                logger.info('Applying migration %d: %s',
+                            i + 1, migration.__name__)
+                migration(db)
+            # Lock the DB before checking the version again, as other
+            # process may be migrating it at the same time.
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if get_user_version(db) > i:
+                    db.execute('ROLLBACK')
+                    continue
+                if transactional:
+                    logger.info('Applying migration %d: %s',
+                                i + 1, migration.__name__)
+                    migration(db)
+                db.execute('PRAGMA user_version = {0:d}'.format(i + 1))
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            applied += 1
+        if get_user_version(db) > len(migrations):
+            warnings.warn(
+                'Database schema is newer than this version of RASH.')
+    finally:
+        db.isolation_level = isolation_level
+    return applied
@@ -6,8 +6,10 @@ This Python implementation is a reference implementation.
 Probably it makes sense to write this command naively in
 shells to make it faster.
 
-The dumped data goes under the ``~/.config/rash/data/record``
-directory.
+The dumped data is sent to the daemon via the socket
+``~/.config/rash/daemon.sock``.  If the daemon is not reachable, it
+is appended to a journal file under the ``~/.config/rash/data/journal``
+directory.  See :mod:`rash.journal`.
 
 """
 
@@ -28,12 +30,14 @@ directory.
 
 
 import os
+import re
+import sys
 import time
-import json
 
-from .utils.pathutils import mkdirp
 from .utils.py3compat import getcwd
 from .config import ConfigStore
+from .journal import get_journal_file, append_record
+from .recordsocket import send_record
 
 
 def get_tty():
@@ -48,11 +52,20 @@ def get_tty():
             pass
 
 
-def get_environ(keys):
+STATIC_ENVIRON_KEYS = ['HOST', 'TTY', 'RASH_SPENV_TERMINAL']
+"""
+Environment variables which :func:`get_environ` computes when unset.
+Their values do not change during a shell session.
+"""
+
+
+def get_environ(keys, environ=None):
     """
     Get environment variables from :data:`os.environ`.
 
-    :type keys: [str]
+    :type    keys: [str]
+    :type environ: dict or None
+    :arg  environ: Use this instead of :data:`os.environ` if given.
     :rtype: dict
 
     Some additional features.
@@ -64,7 +77,9 @@ def get_environ(keys):
     * Set 'RASH_SPENV_TERMINAL' if needed.
 
     """
-    items = ((k, os.environ.get(k)) for k in keys)
+    if environ is None:
+        environ = os.environ
+    items = ((k, environ.get(k)) for k in keys)
     subenv = dict((k, v) for (k, v) in items if v is not None)
     needset = lambda k: k in keys and not subenv.get(k)
 
@@ -99,29 +114,57 @@ def generate_session_id(data):
         host, tty, os.getppid(), data['start']]))
 
 
-def record_run(record_type, print_session_id, **kwds):
+def record_run(record_type, print_session_id, serve, no_config, **kwds):
     """
     Record shell history.
     """
+    if serve:
+        serve_records(sys.stdin, sys.stdout)
+        return
     if print_session_id and record_type != 'init':
         raise RuntimeError(
             '--print-session-id should be used with --record-type=init')
 
     cfstore = ConfigStore()
-    # SOMEDAY: Pass a list of environment variables to shell by "rash
-    # init" and don't read configuration in "rash record" command.  It
-    # is faster.
-    config = cfstore.get_config()
-    envkeys = config.record.environ[record_type]
-    json_path = os.path.join(cfstore.record_path,
-                             record_type,
-                             time.strftime('%Y-%m-%d-%H%M%S.json'))
-    mkdirp(os.path.dirname(json_path))
+    # `rash init` passes the environment variables to record to the
+    # shell, so that it does not need to read the configuration here.
+    config = None if no_config else cfstore.get_config()
+    data = make_record(config, record_type, **kwds)
+
+    if print_session_id:
+        data['session_id'] = generate_session_id(data)
+        print(data['session_id'])
+
+    dump_record(cfstore, record_type, data)
+
+
+def make_record(config, record_type, environ=None, **kwds):
+    """
+    Make a record from command line options.
+
+    :type   config: rash.config.Configuration or None
+    :arg    config: If None, variables given by `environ` are recorded
+                    instead of the ones configured in record.environ.
+    :type  environ: [str] or None
+    :arg   environ: ``NAME=VALUE`` strings given by --environ.
+
+    >>> data = make_record(None, 'command', environ=['PATH=/bin', 'EMPTY='])
+    >>> sorted(data['environ'].items())
+    [('EMPTY', ''), ('PATH', '/bin')]
+
+    """
+    if environ is not None:
+        pairs = [kv.split('=', 1) for kv in environ if '=' in kv]
+        environ = dict(pairs)
+    if config:
+        envkeys = config.record.environ[record_type]
+    else:
+        envkeys = [k for (k, _) in pairs] if environ is not None else []
 
     # Command line options directly map to record keys
     data = dict((k, v) for (k, v) in kwds.items() if v is not None)
     data.update(
-        environ=get_environ(envkeys),
+        environ=get_environ(envkeys, environ),
     )
 
     # Automatically set some missing variables:
@@ -130,13 +173,83 @@ def record_run(record_type, print_session_id, **kwds):
         data.setdefault('stop', int(time.time()))
     elif record_type in ['init']:
         data.setdefault('start', int(time.time()))
+    return data
 
-    if print_session_id:
-        data['session_id'] = generate_session_id(data)
-        print(data['session_id'])
 
-    with open(json_path, 'w') as fp:
-        json.dump(data, fp)
+def dump_record(cfstore, record_type, data):
+    """
+    Send `data` to the daemon or append it to the journal.
+    """
+    if not send_record(cfstore.daemon_socket_path, record_type, data):
+        append_record(get_journal_file(cfstore.journal_path),
+                      record_type, data)
+
+
+def split_fields(line):
+    r"""
+    Split a line given to ``rash record --serve`` into options.
+
+    Fields are separated by tab.  Backslash, tab and newline in
+    each field are escaped as ``\\``, ``\t`` and ``\n``.
+
+    >>> split_fields('--command\tfor x\\tin\\n\\\\\n')
+    ['--command', 'for x\tin\n\\']
+
+    """
+    return [_FIELD_ESCAPE_RE.sub(_unescape_field, f)
+            for f in line.rstrip('\n').split('\t')]
+
+_FIELD_ESCAPE_RE = re.compile(r'\\(.)')
+_FIELD_ESCAPES = {'t': '\t', 'n': '\n'}
+
+
+def _unescape_field(match):
+    char = match.group(1)
+    return _FIELD_ESCAPES.get(char, char)
+
+
+def serve_records(infile, outfile):
+    """
+    Record shell history sent as lines from `infile`.
+
+    Each line is a list of options for ``rash record`` (see
+    :func:`split_fields`).  Configuration is loaded only once, so
+    the per-record cost is just parsing a line.
+
+    Before reading, a space-separated list of environment variables
+    to be recorded is written to `outfile` as the first line.  The
+    shell should pass their values by --environ, as the environment
+    of this process is not updated during the shell session.
+
+    """
+    from .query import SafeArgumentParser
+    cfstore = ConfigStore()
+    config = cfstore.get_config()
+    parser = SafeArgumentParser()
+    record_add_arguments(parser)
+
+    envkeys = set()
+    for record_type in ['command', 'exit']:
+        envkeys.update(config.record.environ[record_type])
+    outfile.write(' '.join(sorted(envkeys)) + '\n')
+    outfile.flush()
+
+    for line in iter(infile.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            kwds = vars(parser.parse_args(split_fields(line)))
+        except ValueError:
+            sys.stderr.write('rash record --serve: invalid line: {0!r}\n'
+                             .format(line))
+            continue
+        for key in ['serve', 'print_session_id']:
+            kwds.pop(key)
+        record_type = kwds.pop('record_type')
+        no_config = kwds.pop('no_config')
+        dump_record(cfstore, record_type,
+                    make_record(None if no_config else config,
+                                record_type, **kwds))
 
 
 def record_add_arguments(parser):
@@ -177,6 +290,31 @@ def record_add_arguments(parser):
         print generated session ID to stdout.
         This option should be used with `init` RECORD_TYPE.
         ''')
+    parser.add_argument(
+        '--environ', metavar='NAME=VALUE', action='append',
+        help='''
+        value of environment variable to record.  If this option is
+        given at least once, the environment of this process is not
+        looked up.  Only variables configured in record.environ are
+        stored.
+        ''')
+    parser.add_argument(
+        '--no-config', default=False, action='store_true',
+        help='''
+        do not read the configuration file.  All variables given by
+        --environ are recorded, including the ones with empty value.
+        This is how the shell hooks call this command, using the
+        variable list given by `rash init`.
+        ''')
+    parser.add_argument(
+        '--serve', default=False, action='store_true',
+        help='''
+        keep reading records from stdin, one record per line, until
+        EOF.  Each line is a tab-separated list of the options above
+        in which backslash, tab and newline are escaped by backslash.
+        Shell hooks use this via a coprocess to avoid starting Python
+        for every command.
+        ''')
 
 
 commands = [
@@ -0,0 +1,103 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import warnings
+
+from .journal import encode_record, decode_record
+
+MAX_DATAGRAM_SIZE = 2 ** 20
+
+
+def send_record(socket_path, record_type, data):
+    """
+    Send a record to the daemon listening at `socket_path`.
+
+    The record is sent as one datagram without blocking.  When the
+    daemon is not running, its queue is full or the record is too
+    large for a datagram, the caller should fall back to the journal.
+
+    :rtype: bool
+    :return: True if the daemon received the record.
+
+    """
+    if not os.path.exists(socket_path):
+        return False
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(encode_record(record_type, data), socket_path)
+        return True
+    except (socket.error, OSError):
+        return False
+    finally:
+        sock.close()
+
+
+class RecordReceiver(object):
+
+    """
+    Receive records sent by :func:`send_record`.
+    """
+
+    def __init__(self, socket_path):
+        import socket
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            # Left by a daemon that was not shut down cleanly.
+            os.remove(socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self, timeout=None):
+        """
+        Yield ``(record_type, data)`` until no record arrives in `timeout`.
+        """
+        import select
+        while True:
+            (readable, _, _) = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return
+            payload = self.sock.recv(MAX_DATAGRAM_SIZE)
+            try:
+                yield decode_record(payload)
+            except ValueError:
+                warnings.warn('Ignoring invalid record sent to: {0}'
+                              .format(self.socket_path))
+
+    def unlink(self):
+        """
+        Remove the socket file so that no more records are sent.
+
+        Records already sent can still be received.  Senders started
+        after this fall back to the journal.
+
+        """
+        if not self.unlinked:
+            self.unlinked = True
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    unlinked = False
+
+    def close(self):
+        self.unlink()
+        self.sock.close()
@@ -13,6 +13,9 @@
 -- You should have received a copy of the GNU General Public License
 -- along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+-- This is the first version of the schema.  Changes to it are made by
+-- the migrations in rash/migrations.py.
+
 
 DROP TABLE IF EXISTS command_history;
 CREATE TABLE command_history (
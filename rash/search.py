@@ -43,7 +43,8 @@ def search_run(output, **kwds):
         'command_count', 'success_count', 'success_ratio', 'program_count'])
     kwds['additional_columns'] = candidates & set(fmtkeys)
 
-    db = DataBase(cfstore.db_path)
+    db = DataBase(cfstore.db_path, readonly=True,
+                  config=cfstore.get_config().database)
     for crec in db.search_command_record(**preprocess_kwds(kwds)):
         output.write(format.format(**crec.__dict__))
 
@@ -325,6 +326,13 @@ def search_add_arguments(parent_parser):
 
     # Misc
     parser = parent_parser.add_argument_group('Misc')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="""
+        Number of processes to match regexps (--match-regexp etc.).
+        This is useful when there are many distinct commands in the
+        history.
+        """)
     parser.add_argument(
         '--output', default='-', type=argparse.FileType('w'),
         help="""
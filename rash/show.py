@@ -21,7 +21,9 @@ def show_run(command_history_id):
     from pprint import pprint
     from .config import ConfigStore
     from .database import DataBase
-    db = DataBase(ConfigStore().db_path)
+    cfstore = ConfigStore()
+    db = DataBase(cfstore.db_path, readonly=True,
+                  config=cfstore.get_config().database)
     with db.connection():
         for ch_id in command_history_id:
             crec = db.get_full_command_record(ch_id)
@@ -0,0 +1,193 @@
+"""
+Layout of JSON record files.
+
+JSON records are written by the native recorders (``rash init
+--native-record``) into a directory partitioned by record type, host
+and day::
+
+  <record_path>/<record_type>/<host>/<YYYY-MM-DD>/<name>.json
+
+so that no directory grows without bound even when many hosts share
+one spool (e.g., over NFS).  Files directly under
+``<record_path>/<record_type>/`` (the layout used by older versions)
+are still understood.
+
+:func:`iter_record_files` enumerates the files partition by
+partition: oldest day first and, within a day, host by host.  Apart
+from the names of the partitions, only the listing of the directory
+being read is held in memory.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+
+from .utils.pathutils import walk_files
+from .utils.py3compat import scandir
+
+RECORD_TYPES = ['command', 'init', 'exit']
+RECORD_SUFFIX = '.json'
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def get_partition_path(record_path, record_type, host=None, ts=None):
+    """
+    Return the directory to store a record of `record_type`.
+
+    `host` defaults to the name of this host and `ts` to now.  The day
+    is taken in local time, like the file names.
+
+    >>> get_partition_path('record', 'command', 'myhost', 0
+    ...                    ) == os.path.join(
+    ...     'record', 'command', 'myhost',
+    ...     time.strftime(DAY_FORMAT, time.localtime(0)))
+    True
+
+    """
+    if host is None:
+        import platform
+        host = platform.node()
+    return os.path.join(
+        record_path, record_type, host.replace(os.path.sep, '_'),
+        time.strftime(DAY_FORMAT, time.localtime(ts)))
+
+
+def parse_record_path(relpath):
+    """
+    Split `relpath` relative to the record path into its partition.
+
+    Return ``(record_type, host, day)``, where missing parts are None.
+    For a file in the old flat layout, `host` and `day` are None.
+    Return None if `relpath` is not in the record path.
+
+    >>> parse_record_path(os.path.join('command', 'h', '2013-01-01', 'x.json'))
+    ('command', 'h', '2013-01-01')
+    >>> parse_record_path(os.path.join('command', 'a.json'))
+    ('command', None, None)
+    >>> parse_record_path(os.path.join('command', 'h'))
+    ('command', 'h', None)
+    >>> parse_record_path(os.curdir)
+    (None, None, None)
+    >>> parse_record_path(os.path.join(os.pardir, 'a.json'))
+
+    """
+    parts = [p for p in os.path.normpath(relpath).split(os.path.sep)
+             if p != os.curdir]
+    if parts and parts[0] == os.pardir:
+        return None
+    if parts and parts[-1].endswith(RECORD_SUFFIX):
+        parts = parts[:-1]
+    if len(parts) > 3:
+        return None
+    parts += [None] * (3 - len(parts))
+    return tuple(parts)
+
+
+def _scan_dir(path):
+    """
+    Return ``(files, dirs)`` directly under `path`, sorted by name.
+
+    `files` is a list of ``(path, stat)`` of record files and `dirs` is
+    a list of ``(name, path)`` of directories.
+
+    """
+    files = []
+    dirs = []
+    if not os.path.isdir(path):
+        return (files, dirs)
+    if scandir is None:
+        for name in sorted(os.listdir(path)):
+            sub = os.path.join(path, name)
+            if os.path.isdir(sub):
+                dirs.append((name, sub))
+            elif name.endswith(RECORD_SUFFIX):
+                files.append((sub, os.stat(sub)))
+        return (files, dirs)
+    it = scandir(path)
+    try:
+        entries = sorted(it, key=lambda e: e.name)
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    for entry in entries:
+        if entry.is_dir():
+            dirs.append((entry.name, entry.path))
+        elif entry.name.endswith(RECORD_SUFFIX):
+            files.append((entry.path, entry.stat()))
+    return (files, dirs)
+
+
+def _iter_type_dir(path):
+    (files, hosts) = _scan_dir(path)
+    # Files in the old flat layout come first, as they are older.
+    for item in files:
+        yield item
+    days = {}
+    for (_, host_dir) in hosts:
+        for (day, day_dir) in _scan_dir(host_dir)[1]:
+            days.setdefault(day, []).append(day_dir)
+    for day in sorted(days):
+        for day_dir in days.pop(day):
+            for item in _scan_dir(day_dir)[0]:
+                yield item
+
+
+def _iter_host_dir(path):
+    (files, days) = _scan_dir(path)
+    for item in files:
+        yield item
+    for (_, day_dir) in days:
+        for item in _scan_dir(day_dir)[0]:
+            yield item
+
+
+def iter_record_files(record_path, top=None):
+    """
+    Yield ``(path, stat)`` of record files under `top` in order.
+
+    :type record_path: str
+    :arg  record_path: Root of the spool (``ConfigStore.record_path``).
+    :type         top: str or None
+    :arg          top: Directory under `record_path` to enumerate.
+                       Default to `record_path`.
+
+    Records of each type are yielded day by day across all hosts.
+    Files in subdirectories of day directories are not records, so
+    they are not yielded.
+
+    """
+    top = record_path if top is None else top
+    parsed = parse_record_path(os.path.relpath(top, record_path))
+    if parsed is None:
+        if os.path.isdir(top):
+            for item in walk_files(top, RECORD_SUFFIX):
+                yield item
+    elif parsed[0] is None:
+        for record_type in RECORD_TYPES:
+            for item in _iter_type_dir(os.path.join(top, record_type)):
+                yield item
+    elif parsed[1] is None:
+        for item in _iter_type_dir(top):
+            yield item
+    elif parsed[2] is None:
+        for item in _iter_host_dir(top):
+            yield item
+    else:
+        for item in _scan_dir(top)[0]:
+            yield item
@@ -0,0 +1,68 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import tempfile
+import shutil
+
+from ..config import ConfigStore
+from ..daemon import lock_pid_file, read_pid_file, is_daemon_alive
+from .utils import BaseTestCase
+
+
+class TestPIDFile(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.cfstore = ConfigStore(self.base_path)
+        self.pid_path = self.cfstore.daemon_pid_path
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_no_pid_file(self):
+        self.assertFalse(is_daemon_alive(self.cfstore))
+        self.assertEqual(read_pid_file(self.pid_path), None)
+
+    def test_lock_pid_file(self):
+        fd = lock_pid_file(self.pid_path)
+        try:
+            os.write(fd, b'12345')
+            self.assertTrue(is_daemon_alive(self.cfstore))
+            self.assertEqual(lock_pid_file(self.pid_path, retry=0), None)
+            self.assertEqual(read_pid_file(self.pid_path), 12345)
+        finally:
+            os.close(fd)
+        self.assertFalse(is_daemon_alive(self.cfstore))
+
+    def test_stale_pid_file(self):
+        with open(self.pid_path, 'w') as f:
+            f.write(str(os.getpid()))
+        self.assertFalse(is_daemon_alive(self.cfstore))
+        fd = lock_pid_file(self.pid_path, retry=0)
+        self.assertNotEqual(fd, None)
+        os.close(fd)
+
+    def test_lock_removed_pid_file(self):
+        fd = lock_pid_file(self.pid_path)
+        os.remove(self.pid_path)
+        os.close(fd)
+        fd = lock_pid_file(self.pid_path, retry=0)
+        try:
+            self.assertTrue(os.path.exists(self.pid_path))
+            self.assertTrue(is_daemon_alive(self.cfstore))
+        finally:
+            os.close(fd)
@@ -15,13 +15,17 @@
 
 
 import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing
 import datetime
 import itertools
 import string
 import operator
 
 from ..model import CommandRecord, SessionRecord
-from ..database import DataBase, normalize_directory
+from ..database import DataBase, QueryHandle, normalize_directory
 from ..utils.py3compat import nested
 from .utils import BaseTestCase, monkeypatch, zip_dict
 
@@ -72,6 +76,7 @@ class InMemoryDataBase(DataBase):
         db = sqlite3.connect(':memory:')
         self._get_db = lambda: db
         self._init_db()
+        self.migrate()
         self.update_version_records()
 
 
@@ -213,6 +218,40 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assert_same_command_record(records[0], to_command_record(data))
         self.assertEqual(len(records), 1)
 
+    def test_check_duplicate_with_missing_fields(self):
+        data = {'session_id': 'DUMMY-SESSION-ID', 'command': 'DUMMY COMMAND'}
+        for _ in range(2):
+            self.import_command_record(dict(data), check_duplicate=True)
+        self.assertEqual(len(self.search_command_record(unique=False)), 1)
+
+        # Missing (NULL) field is not a duplicate of any value:
+        for (key, value) in [('cwd', self.abspath()), ('terminal', ''),
+                             ('start', 0), ('stop', 0), ('exit_code', 0)]:
+            self.import_command_record(dict(data, **{key: value}),
+                                       check_duplicate=True)
+        self.import_command_record(dict(data, command=None),
+                                   check_duplicate=True)
+        self.import_command_record(dict(data, command=None),
+                                   check_duplicate=True)
+        self.assertEqual(
+            len(self.search_command_record(unique=False, limit=-1)), 7)
+
+    def test_check_duplicate_int_and_string_timestamps(self):
+        data = self.get_dummy_command_record_data()
+        self.import_command_record(dict(data), check_duplicate=True)
+        # Timestamps are compared as stored in DB:
+        self.import_command_record(
+            dict(data, start='1970-01-01 00:01:40',
+                 stop='1970-01-01 00:01:42'),
+            check_duplicate=True)
+        self.assertEqual(len(self.search_command_record(unique=False)), 1)
+
+        self.import_command_record(
+            dict(data, start='1970-01-01 00:01:41'), check_duplicate=True)
+        self.import_command_record(dict(data, start=101),
+                                   check_duplicate=True)
+        self.assertEqual(len(self.search_command_record(unique=False)), 2)
+
     def prepare_command_history_table(self, keys, lists):
         """
         Import command records specified by values in `lists`.
@@ -334,6 +373,120 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assert_same_command_record(records[0], dcrec2)
         self.assertEqual(len(records), 1)
 
+    def test_search_command_by_literal_prefix(self):
+        import re
+        from fnmatch import fnmatchcase
+        commands = ['make', 'make all', 'makefile', 'makf', 'mak', 'b',
+                    u'caf\u00e9', u'caf\u00e9 x', u'a\U0010ffff',
+                    u'a\U0010ffffb', u'a\ud7ff!']
+        self.prepare_command_record(commands)
+
+        def search(**kwds):
+            for unique in [False, True]:
+                records = self.search_command_record(
+                    unique=unique, limit=-1, **kwds)
+                yield sorted(r.command for r in records)
+
+        for pattern in ['make*', 'mak?', 'make', u'caf\u00e9*',
+                        u'a\U0010ffff*', u'a\ud7ff*', '*ake']:
+            expected = sorted(c for c in commands if fnmatchcase(c, pattern))
+            for actual in search(match_pattern=[pattern]):
+                self.assertEqual(actual, expected)
+        for pattern in ['make', '^make ', 'make?', r'mak[ef]', r'make\ ',
+                        'b|make', u'a\U0010ffff']:
+            expected = sorted(c for c in commands if re.match(pattern, c))
+            for actual in search(match_regexp=[pattern]):
+                self.assertEqual(actual, expected)
+        for actual in search(include_pattern=['b*', 'makf']):
+            self.assertEqual(actual, ['b', 'makf'])
+        for actual in search(include_regexp=['b', '.*all']):
+            self.assertEqual(actual, ['b', 'make all'])
+
+    def test_search_command_by_regexp_ignore_case(self):
+        import re
+        commands = ['git status', 'GIT STATUS', 'Git Diff', 'hg status',
+                    u'\u212a ls', 'k ls', 'make -C src']
+        self.prepare_command_record(commands)
+
+        for pattern in ['git', '.*status', '.*st.*us$', r'.*\bdiff',
+                        'k', 'make -c', 'hg|git']:
+            for ignore_case in [False, True]:
+                flags = re.IGNORECASE if ignore_case else 0
+                expected = sorted(c for c in commands
+                                  if re.match(pattern, c, flags))
+                records = self.search_command_record(
+                    match_regexp=[pattern], ignore_case=ignore_case,
+                    unique=False, limit=-1)
+                self.assertEqual(sorted(r.command for r in records),
+                                 expected)
+
+    def test_search_command_matches_each_command_once(self):
+        from .. import database
+        self.prepare_command_record(
+            ['git status'] * 4 + ['hg status'] * 2 + ['ls'],
+            start=range(7))
+        calls = []
+        orig = database.SQLRegexpFunc.__call__
+
+        def regexp(self, expr, item, flags=0):
+            calls.append(item)
+            return orig(self, expr, item, flags)
+
+        with monkeypatch(database.SQLRegexpFunc, '__call__', regexp):
+            records = self.search_command_record(
+                match_regexp=['[gh].*'], unique=False)
+        self.assertEqual(len(records), 6)
+        self.assertEqual(sorted(calls), ['git status', 'hg status', 'ls'])
+
+    def test_search_command_by_regexp_in_parallel(self):
+        self.prepare_command_record(
+            ['git status', 'GIT DIFF', 'hg status', 'ls', None] * 3,
+            start=range(15))
+        self.db.regexp_parallel_threshold = 0
+        for kwds in [dict(match_regexp=['git', '.*st']),
+                     dict(include_regexp=['hg', 'l'], unique=False),
+                     dict(exclude_regexp=['.*status'], ignore_case=True),
+                     dict(include_regexp=['.*diff'], ignore_case=True,
+                          context=1)]:
+            self.assertEqual(
+                [r.command_history_id for r in
+                 self.search_command_record(jobs=2, **kwds)],
+                [r.command_history_id for r in
+                 self.search_command_record(jobs=1, **kwds)])
+
+    def test_match_regexp_in_pool_without_fork(self):
+        import threading
+        from .. import database
+        self.prepare_command_record(['git status', 'hg status'])
+        self.db.regexp_parallel_threshold = 0
+        event = threading.Event()
+        thread = threading.Thread(target=event.wait)
+        thread.start()
+        try:
+            with monkeypatch(database, 'get_process_context', lambda: None):
+                self.assertEqual(self.db._match_regexp_in_pool(
+                    2, ['git'], [], [], False), None)
+        finally:
+            event.set()
+            thread.join()
+
+    def test_search_command_by_time_and_duration(self):
+        self.prepare_command_record(
+            ['A', 'B', 'C', 'D'],
+            start=[0, 3600, 7200, 100], stop=[10, 3600 + 600, 7201, 102])
+
+        def search(**kwds):
+            records = self.search_command_record(unique=False, **kwds)
+            return sorted(r.command for r in records)
+
+        self.assertEqual(search(time_after='1970-01-01 01:00:00'), ['B', 'C'])
+        self.assertEqual(
+            search(time_after=datetime.datetime(1970, 1, 1, 1),
+                   time_before=datetime.datetime(1970, 1, 1, 1, 59)),
+            ['B'])
+        self.assertEqual(search(duration_longer_than=10), ['A', 'B'])
+        self.assertEqual(search(duration_less_than=10), ['A', 'C', 'D'])
+
     def test_search_command_by_cwd(self):
         cwd_list = [self.abspath('DUMMY', 'A'), self.abspath('DUMMY', 'B')]
         (dcrec1, dcrec2) = self.prepare_command_record(cwd=cwd_list)
@@ -416,6 +569,52 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assertEqual(attrs('success_count'), [3, 2, 0])
         self.assertEqual(attrs('success_ratio'), [1.0, 0.5, 0.0])
 
+    def test_search_command_sort_by_program_count(self):
+        commands = ['git status', 'git log', 'GIT_DIR=. git diff',
+                    'hg status', 'hg status', 'ls']
+        self.prepare_command_record(command=commands,
+                                    start=range(len(commands)))
+
+        records = self.search_command_record(sort_by=['program_count'],
+                                             limit=-1)
+        attrs = lambda key: [getattr(r, key) for r in records]
+        self.assertEqual(attrs('program_count'), [3, 3, 3, 2, 1])
+        self.assertEqual(set(attrs('command')[:3]),
+                         set(['git status', 'git log', 'GIT_DIR=. git diff']))
+        self.assertEqual(attrs('command')[3:], ['hg status', 'ls'])
+
+    def test_search_command_with_command_stats(self):
+        commands = ['A', 'B', 'A', 'C', 'A', 'B']
+        self.prepare_command_record(
+            command=commands, start=[3, 1, 2, 4, 6, 5],
+            stop=[4, 3, 5, 4, 6, 9], exit_code=[0, 1, 1, 0, 0, 0])
+        with self.db.connection() as connection:
+            stats = connection.execute(
+                'SELECT CL.command, count, success_count, total_duration '
+                'FROM command_stats JOIN command_list AS CL '
+                'ON command_id = CL.id ORDER BY CL.command').fetchall()
+        self.assertEqual([row[:3] for row in stats],
+                         [('A', 3, 2), ('B', 2, 1), ('C', 1, 1)])
+        for (row, duration) in zip(stats, [4, 6, 0]):
+            self.assertAlmostEqual(row[3], duration, places=3)
+
+        keys = ['command_history_id', 'command', 'start', 'stop',
+                'command_count', 'success_count', 'success_ratio']
+        get = lambda records: [[getattr(r, k) for k in keys]
+                               for r in records]
+        kwds = dict(additional_columns=['command_count', 'success_count'])
+        records = get(self.search_command_record(**kwds))
+        # The same result without command_stats (time_after disables
+        # it as it has to be checked for each command):
+        self.assertEqual(
+            get(self.search_command_record(
+                time_after='1970-01-01 00:00:00', **kwds)),
+            records)
+        self.assertEqual(attrs(self.search_command_record(**kwds), 'command'),
+                         ['A', 'B', 'C'])
+        self.assertEqual(records[0][:2], [5, 'A'])
+        self.assertEqual(records[0][4:], [3, 2, 2.0 / 3])
+
     def test_search_command_sort_by_cwd_distance(self):
         command_list = [
             'A',
@@ -892,6 +1091,45 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assertEqual(result_command, ['c-2', 'c-1-match',
                                           'c-6', 'c-5-match'])
 
+    def test_serach_command_with_context_and_limit(self):
+        command = ['c-{0}{1}'.format(i, '-match' if i % 5 == 1 else '')
+                   for i in range(20)]
+        self.prepare_command_record(command=command, start=range(20))
+
+        def search(**kwds):
+            return [r.command for r in self.search_command_record(
+                include_pattern=['*match'], **kwds)]
+
+        for kwds in [dict(context=2), dict(before_context=1),
+                     dict(after_context=3, reverse=True)]:
+            records = search(limit=-1, **kwds)
+            self.assertTrue(records)
+            for limit in [1, 4, 10]:
+                self.assertEqual(search(limit=limit, **kwds),
+                                 records[:limit])
+
+    def test_serach_command_with_session_context_in_same_session(self):
+        command = ['c-0', 'c-1-match', 'c-2', 'c-3-match', 'c-4']
+        session_id = ['S-0', 'S-1', 'S-0', 'S-1', 'S-0']
+        self.prepare_command_record(command=command, start=range(5),
+                                    session_id=session_id)
+        self.db.import_init_dict({'session_id': 'S-0', 'start': 0})
+        self.db.import_init_dict({'session_id': 'S-1', 'start': 1})
+        records = self.search_command_record(include_pattern=['*match'],
+                                             context=1, limit=-1,
+                                             context_type='session')
+        self.assertEqual([r.command for r in records],
+                         ['c-3-match', 'c-1-match'])
+
+    def test_serach_command_with_context_of_same_start(self):
+        command = ['c-{0}{1}'.format(i, '-match' if i == 2 else '')
+                   for i in range(5)]
+        self.prepare_command_record(command=command, start=[0] * 5)
+        records = self.search_command_record(include_pattern=['*match'],
+                                             context=1, limit=-1)
+        self.assertEqual([r.command for r in records],
+                         ['c-3', 'c-2-match', 'c-1'])
+
     def search_session_record(self, **kwds):
         return list(self.db.search_session_record(**kwds))
 
@@ -1048,3 +1286,229 @@ class TestInMemoryDataBase(BaseTestCase):
 
         crec = self.db.get_full_command_record(command_history_id)
         self.assertEqual(crec.pipestatus, command_data['pipestatus'])
+
+    def test_id_cache_is_consistent_after_rollback(self):
+        command_data = self.get_dummy_command_record_data()
+        try:
+            with self.db.connection(commit=True):
+                self.import_command_record(dict(command_data))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(len(self.search_command_record()), 0)
+
+        # IDs inserted by the rolled back transaction must not be used:
+        self.import_command_record(dict(command_data))
+        records = self.search_command_record()
+        self.assertEqual(len(records), 1)
+        self.assert_same_command_record(
+            records[0], to_command_record(command_data))
+        crec = self.db.get_full_command_record(records[0].command_history_id)
+        self.assertEqual(crec.environ, command_data['environ'])
+
+    def test_import_many(self):
+        data = self.get_dummy_command_record_data()
+        dcts = [dict(data, command='COMMAND-{0}'.format(i),
+                     pipestatus=[i, 0], environ={'I': str(i)})
+                for i in range(5)]
+        # The last one is a duplicate of the first one:
+        dcts.append(dcts[0])
+        for dct in dcts:
+            self.adapt_file_path_in_dict(dct)
+        self.db.import_many(dcts, chunk_size=2)
+
+        records = self.search_command_record(unique=False)
+        self.assertEqual(len(records), 5)
+        for crec in records:
+            i = int(crec.command.split('-')[1])
+            self.assert_same_command_record(
+                crec, to_command_record(dcts[i]))
+            full = self.db.get_full_command_record(crec.command_history_id)
+            self.assertEqual(full.environ, {'I': str(i)})
+            self.assertEqual(full.pipestatus, [i, 0])
+
+        self.db.import_many(dcts, check_duplicate=False)
+        records = self.search_command_record(unique=False, limit=-1)
+        self.assertEqual(len(records), 5 + len(dcts))
+
+
+class TestDataBaseFile(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.dbpath = os.path.join(self.base_path, 'db.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    @staticmethod
+    def get_commands(db):
+        return [row[0] for row in db._executing(
+            'SELECT command FROM command_list ORDER BY command')]
+
+    def test_wal_mode(self):
+        db = DataBase(self.dbpath)
+        with db.connection() as connection:
+            (mode,) = connection.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual(mode, 'wal')
+
+    def test_readonly_connection(self):
+        # The DB is created even if it is opened as read-only first:
+        reader = DataBase(self.dbpath, readonly=True)
+        self.assertEqual(self.get_commands(reader), [])
+        with reader.connection() as connection:
+            self.assertRaises(
+                sqlite3.OperationalError, connection.execute,
+                'DELETE FROM command_history')
+
+    def test_readonly_connection_does_not_block_writer(self):
+        writer = DataBase(self.dbpath)
+        writer.import_dict(dict(session_id='SID', command='A',
+                                cwd=os.path.sep, stop=1))
+        reader = DataBase(self.dbpath, readonly=True)
+        with reader.connection():
+            commands = reader._executing('SELECT command FROM command_list')
+            self.assertEqual(next(commands), ('A',))
+            # The reader is in the middle of a read transaction:
+            writer.import_dict(dict(session_id='SID', command='B',
+                                    cwd=os.path.sep, stop=2))
+        self.assertEqual(self.get_commands(reader), ['A', 'B'])
+
+    def test_check_duplicate_of_backfilled_rows(self):
+        # Rows stored before command_history.fingerprint is added:
+        with closing(sqlite3.connect(self.dbpath)) as db:
+            with open(DataBase.schemapath) as f:
+                db.executescript(f.read())
+            db.execute(
+                "INSERT INTO command_list (id, command) VALUES (1, 'ls')")
+            db.execute('INSERT INTO directory_list (id, directory) '
+                       'VALUES (1, ?)', [os.path.sep])
+            db.executemany(
+                'INSERT INTO command_history (command_id, directory_id, '
+                'start_time, stop_time, exit_code) VALUES (1, ?, ?, ?, ?)',
+                [(1, '1970-01-01 00:01:40', '1970-01-01 00:01:42', 0),
+                 (None, None, None, None)])
+            db.commit()
+
+        db = DataBase(self.dbpath)  # backfilled by the migration
+        data = dict(session_id='SID', command='ls', cwd=os.path.sep,
+                    start=100, stop=102, exit_code=0)
+        db.import_dict(dict(data), check_duplicate=True)
+        db.import_dict(dict(session_id='SID', command='ls'),
+                       check_duplicate=True)
+        self.assertEqual(self.count_command_history(db), 2)
+
+        # Rows inserted later are found in the same way:
+        for dct in [dict(data, stop=103), dict(data, stop=103)]:
+            db.import_dict(dct, check_duplicate=True)
+        self.assertEqual(self.count_command_history(db), 3)
+
+    @staticmethod
+    def count_command_history(db):
+        (num,) = next(db._executing('SELECT COUNT(*) FROM command_history'))
+        return num
+
+    def import_commands(self, db, commands):
+        for (i, command) in enumerate(commands):
+            db.import_dict(dict(session_id='SID', command=command,
+                                cwd=os.path.sep, stop=i))
+
+    def run_in_thread(self, func, *args):
+        import threading
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_connection_per_thread(self):
+        db = DataBase(self.dbpath)
+        self.import_commands(db, ['A', 'B'])
+        with db.connection() as connection:
+            other = self.run_in_thread(
+                lambda: next(db._executing('SELECT 1')) and db._state.db)
+            assert other is not connection
+            self.assertEqual(db._state.db, connection)
+        self.assertEqual(db._state.db, None)
+
+    def test_consume_search_in_other_thread(self):
+        db = DataBase(self.dbpath, readonly=True)
+        self.import_commands(DataBase(self.dbpath), ['A', 'B', 'C'])
+        commands = db._executing(
+            'SELECT command FROM command_list ORDER BY command')
+        self.assertEqual(self.run_in_thread(next, commands), ('A',))
+        self.assertEqual(next(commands), ('B',))
+        commands.close()
+        self.assertEqual(db._state.db, None)
+
+    def test_interrupt(self):
+        db = DataBase(self.dbpath, readonly=True)
+        self.import_commands(DataBase(self.dbpath), ['A', 'B', 'C'])
+        handle = QueryHandle()
+        commands = db._executing('SELECT command FROM command_list',
+                                 handle=handle)
+        others = db._executing('SELECT command FROM command_list')
+        self.assertEqual(self.run_in_thread(next, commands), ('A',))
+        self.assertEqual(next(others), ('A',))
+        handle.interrupt()
+        self.assertEqual(self.run_in_thread(list, commands), [])
+        self.assertEqual(handle.db, None)
+        # Query on the other connection is not affected:
+        self.assertEqual(list(others), [('B',), ('C',)])
+        # Next query is not affected:
+        self.assertEqual(len(list(db._executing(
+            'SELECT command FROM command_list'))), 3)
+
+    def test_interrupt_search(self):
+        db = DataBase(self.dbpath, readonly=True)
+        self.import_commands(DataBase(self.dbpath), ['A', 'B', 'C'])
+        handle = QueryHandle()
+        kwds = TestInMemoryDataBase('run').get_default_search_kwds()
+        kwds.update(unique=False, limit=-1)
+        records = db.search_command_record(handle=handle, **kwds)
+        self.run_in_thread(next, records)
+        handle.interrupt()
+        self.assertEqual(list(records), [])
+
+    def search_commands(self, db, **kwds):
+        defaults = TestInMemoryDataBase('run').get_default_search_kwds()
+        defaults.update(unique=False, limit=-1)
+        defaults.update(kwds)
+        return sorted(r.command for r in db.search_command_record(**defaults))
+
+    def test_command_fts(self):
+        db = DataBase(self.dbpath)
+        with db.connection() as connection:
+            if not db.sync_command_fts(connection):
+                self.skipTest('FTS5 trigram tokenizer is not available')
+        self.import_commands(db, ['git status', 'git stash', 'GIT_DIR=x ls',
+                                  'hg status', 'git status'])
+        self.assertTrue(db._is_command_fts_ready())
+        kwds = dict(match_pattern=['git st*'], include_pattern=['*tat*'])
+        expected = ['git status', 'git status']
+        self.assertEqual(self.search_commands(db, **kwds), expected)
+        self.assertEqual(
+            self.search_commands(db, match_pattern=['*IT*']), ['GIT_DIR=x ls'])
+        # "]" just after "[^" is a member of the set:
+        self.import_commands(db, ['xqdef', 'x]abcdef'])
+        self.assertEqual(
+            self.search_commands(db, match_pattern=['*[^]abc]def*']),
+            ['xqdef'])
+
+        # Commands missing in the index are still found:
+        with closing(sqlite3.connect(self.dbpath)) as connection:
+            connection.execute('DELETE FROM command_fts WHERE rowid > 1')
+            connection.commit()
+        self.assertFalse(db._is_command_fts_ready())
+        self.assertEqual(self.search_commands(db, **kwds), expected)
+        # Then they are added when something is committed:
+        self.import_commands(db, ['git stats'])
+        self.assertTrue(db._is_command_fts_ready())
+        self.assertEqual(self.search_commands(db, **kwds),
+                         ['git stats'] + expected)
+
+    def test_invalid_synchronous(self):
+        from ..config import DatabaseConfig
+        config = DatabaseConfig()
+        config.synchronous = 'SOMETIMES'
+        self.assertRaises(ValueError, DataBase, self.dbpath, config=config)
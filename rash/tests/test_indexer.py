@@ -18,9 +18,13 @@ import os
 import tempfile
 import shutil
 import json
+import warnings
 
 from ..config import ConfigStore
 from ..indexer import Indexer
+from ..utils.procutils import get_process_context
+from ..journal import get_journal_file, append_record, read_journal, \
+    load_offset
 from ..utils.pathutils import mkdirp
 from .utils import BaseTestCase
 
@@ -81,3 +85,200 @@ class TestIndexer(BaseTestCase):
         indexer.index_all()
         actual_paths = list(indexer.find_record_files())
         self.assertEqual(actual_paths, [])
+
+    def prepare_journal(self, **records):
+        journal_file = get_journal_file(self.cfstore.journal_path, 'HOST')
+        for (rectype, data_list) in sorted(records.items()):
+            for data in data_list:
+                append_record(journal_file, rectype, data)
+        return journal_file
+
+    def count_command_history(self, indexer):
+        with indexer.db.connection() as connection:
+            (num,) = connection.execute(
+                'SELECT COUNT(*) FROM command_history').fetchone()
+        return num
+
+    def test_index_journal_resumes_from_offset(self):
+        journal_file = self.prepare_journal(
+            **self.get_dummy_records(num_command=3))
+        indexer = self.get_indexer(keep_json=True, check_duplicate=False)
+        indexer.index_all()
+        self.assertEqual(self.count_command_history(indexer), 3)
+        self.assertEqual(load_offset(journal_file),
+                         os.path.getsize(journal_file))
+
+        # Already consumed records must not be imported again:
+        indexer.index_all()
+        self.assertEqual(self.count_command_history(indexer), 3)
+
+        append_record(journal_file, 'command', dict(session_id='SID-3'))
+        indexer.index_journal(journal_file)
+        self.assertEqual(self.count_command_history(indexer), 4)
+
+    def test_index_journal_and_truncate(self):
+        journal_file = self.prepare_journal(**self.get_dummy_records())
+        indexer = self.get_indexer(keep_json=False)
+        indexer.index_all()
+        self.assertEqual(self.count_command_history(indexer), 1)
+        self.assertEqual(os.path.getsize(journal_file), 0)
+        self.assertEqual(load_offset(journal_file), 0)
+
+        append_record(journal_file, 'command', dict(session_id='SID-1'))
+        indexer.index_all()
+        self.assertEqual(self.count_command_history(indexer), 2)
+
+    def test_read_journal_stops_at_partial_frame(self):
+        journal_file = self.prepare_journal(command=[dict(command='A')])
+        size = os.path.getsize(journal_file)
+        with open(journal_file, 'ab') as f:
+            f.write(b'100\n[')
+        records = list(read_journal(journal_file))
+        self.assertEqual(records, [('command', dict(command='A'), size)])
+
+    def test_read_journal_skips_torn_frame(self):
+        journal_file = self.prepare_journal(command=[dict(command='A')])
+        with open(journal_file, 'ab') as f:
+            # Payload cut short, and a header which is not a number:
+            f.write(b'100\n["command", {"comm')
+            f.write(b'xyz\n')
+        append_record(journal_file, 'command', dict(command='B'))
+        size = os.path.getsize(journal_file)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            records = list(read_journal(journal_file))
+        self.assertEqual([r[1] for r in records],
+                         [dict(command='A'), dict(command='B')])
+        self.assertEqual(records[-1][2], size)
+        self.assertEqual(len(caught), 1)
+
+        # The saved offset is past the broken frame, so the journal
+        # can be truncated:
+        indexer = self.get_indexer(keep_json=False, check_duplicate=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            indexer.index_journal(journal_file)
+        self.assertEqual(self.count_command_history(indexer), 2)
+        self.assertEqual(os.path.getsize(journal_file), 0)
+
+    def test_read_journal_waits_for_frame_after_broken_one(self):
+        journal_file = self.prepare_journal(command=[dict(command='A')])
+        size = os.path.getsize(journal_file)
+        with open(journal_file, 'ab') as f:
+            f.write(b'xyz\n')
+        records = list(read_journal(journal_file))
+        self.assertEqual(records, [('command', dict(command='A'), size)])
+
+    def test_index_batch(self):
+        (json_path,) = self.prepare_records(
+            command=[dict(session_id='SID-0', command='A')])
+        journal_file = self.prepare_journal(
+            command=[dict(session_id='SID-1', command='B')])
+        indexer = self.get_indexer(keep_json=False, check_duplicate=False)
+        indexer.index_batch([
+            ('record', json_path),
+            ('journal', journal_file),
+            ('dict', ('command', dict(session_id='SID-2', command='C'))),
+            # Duplicated events must be ignored:
+            ('record', json_path),
+            ('journal', journal_file),
+        ])
+        self.assertEqual(self.count_command_history(indexer), 3)
+        self.assertFalse(os.path.exists(json_path))
+        self.assertEqual(os.path.getsize(journal_file), 0)
+
+    def test_find_new_record_files(self):
+        paths = self.prepare_records(**self.get_dummy_records())
+        indexer = self.get_indexer(keep_json=True)
+        self.assertSetEqual(set(indexer.find_new_record_files()), set(paths))
+        indexer.index_all()
+        self.assertEqual(indexer.find_new_record_files(), [])
+
+        # Changing mtime only does not make a file new:
+        st = os.stat(paths[0])
+        os.utime(paths[0], (st.st_atime, st.st_mtime + 10))
+        self.assertEqual(indexer.find_new_record_files(), [])
+
+        with open(paths[0], 'w') as f:
+            json.dump(dict(session_id='SID-NEW'), f)
+        self.assertEqual(indexer.find_new_record_files(), [paths[0]])
+
+    def test_index_all_in_parallel(self):
+        commands = ['CMD-{0}'.format(i) for i in range(20)]
+        self.prepare_records(command=[
+            dict(session_id='SID-0', command=c, start=i, stop=i + 1)
+            for (i, c) in enumerate(commands)])
+        indexer = Indexer(self.cfstore, False, False, jobs=2)
+        indexer.parallel_threshold = 10
+        indexer.index_all()
+        with indexer.db.connection() as connection:
+            rows = connection.execute(
+                'SELECT command FROM command_history '
+                'JOIN command_list ON command_id = command_list.id '
+                'ORDER BY command_history.id').fetchall()
+        self.assertEqual([r[0] for r in rows], commands)
+
+    def test_process_context_does_not_fork(self):
+        # Indexer may run in the daemon, which has other threads.
+        context = get_process_context()
+        if context is None:
+            self.skipTest('multiprocessing contexts are not available')
+        self.assertNotEqual(context.get_start_method(), 'fork')
+
+    def test_index_all_partitioned_records(self):
+        layout = [
+            ('command', 'host-b', '2013-01-02', 'B2'),
+            ('command', 'host-a', '2013-01-02', 'A2'),
+            ('command', 'host-b', '2013-01-01', 'B1'),
+            ('init', 'host-a', '2013-01-01', None),
+        ]
+        for (i, (rectype, host, day, command)) in enumerate(layout):
+            json_path = os.path.join(self.cfstore.record_path, rectype,
+                                     host, day, '{0:05d}.json'.format(i))
+            mkdirp(os.path.dirname(json_path))
+            with open(json_path, 'w') as f:
+                json.dump(dict(session_id='SID', command=command), f)
+            self.assertEqual(self.get_indexer().get_record_type(json_path),
+                             rectype)
+        self.prepare_records(command=[dict(session_id='SID', command='OLD')])
+
+        indexer = self.get_indexer(keep_json=False, check_duplicate=False)
+        indexer.chunk_size = 2
+        indexer.index_all()
+        with indexer.db.connection() as connection:
+            rows = connection.execute(
+                'SELECT command FROM command_history '
+                'JOIN command_list ON command_id = command_list.id '
+                'ORDER BY command_history.id').fetchall()
+        # Old flat files first, then day by day and host by host:
+        self.assertEqual([r[0] for r in rows], ['OLD', 'B1', 'A2', 'B2'])
+        self.assertEqual(list(indexer.find_record_files()), [])
+
+    def test_index_all_ignores_nested_directory(self):
+        day_dir = os.path.join(self.cfstore.record_path, 'command',
+                               'host', '2013-01-01')
+        paths = []
+        for (subdir, command) in [('', 'A'), ('stray', 'B')]:
+            json_path = os.path.join(day_dir, subdir, '00000.json')
+            mkdirp(os.path.dirname(json_path))
+            with open(json_path, 'w') as f:
+                json.dump(dict(session_id='SID', command=command), f)
+            paths.append(json_path)
+
+        indexer = self.get_indexer(keep_json=False, check_duplicate=False)
+        indexer.index_all()
+        self.assertEqual(self.count_command_history(indexer), 1)
+        # A file found by the watcher is ignored as well:
+        indexer.index_batch([('record', paths[1])])
+        self.assertEqual(self.count_command_history(indexer), 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+
+    def test_check_partitioned_record_path(self):
+        record_path = self.cfstore.record_path
+        indexer = self.get_indexer()
+        indexer.check_path(os.path.join(record_path, 'command', 'host'))
+        self.assertRaises(
+            RuntimeError, indexer.check_path,
+            os.path.join(record_path, 'command', 'a', 'b', 'c', 'x.json'))
+        self.assertRaises(RuntimeError, indexer.check_path, record_path)
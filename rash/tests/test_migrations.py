@@ -0,0 +1,188 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sqlite3
+
+from ..database import DataBase, command_fingerprint
+from ..migrations import MIGRATIONS, migrate, get_user_version, get_columns
+from .utils import BaseTestCase
+
+
+class TestMigrations(BaseTestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        with open(DataBase.schemapath) as f:
+            self.db.executescript(f.read())
+
+    def tearDown(self):
+        self.db.close()
+
+    def get_indexes(self, table):
+        return [row[1] for row in self.db.execute(
+            'PRAGMA index_list({0})'.format(table))]
+
+    def test_migrate(self):
+        self.assertEqual(get_user_version(self.db), 0)
+        self.assertEqual(migrate(self.db), len(MIGRATIONS))
+        self.assertEqual(get_user_version(self.db), len(MIGRATIONS))
+        assert 'fingerprint' in get_columns(self.db, 'command_history')
+        assert 'command_history_session_id_start_time' in \
+            self.get_indexes('command_history')
+        assert 'pipe_status_map_ch_id' in self.get_indexes('pipe_status_map')
+        # Nothing to do for the second time:
+        self.assertEqual(migrate(self.db), 0)
+
+    def test_migrate_partially(self):
+        self.assertEqual(migrate(self.db, MIGRATIONS[:1]), 1)
+        self.assertEqual(get_user_version(self.db), 1)
+        self.assertEqual(migrate(self.db), len(MIGRATIONS) - 1)
+
+    def test_failed_migration_is_rolled_back(self):
+        def broken(db):
+            db.execute('CREATE TABLE broken (id INTEGER)')
+            raise ValueError
+
+        self.assertRaises(ValueError, migrate, self.db,
+                          MIGRATIONS[:1] + [broken])
+        self.assertEqual(get_user_version(self.db), 1)
+        self.assertEqual(get_columns(self.db, 'broken'), [])
+
+    def test_backfill_fingerprint(self):
+        self.db.execute(
+            "INSERT INTO command_list (id, command) VALUES (1, 'ls')")
+        self.db.execute(
+            "INSERT INTO directory_list (id, directory) VALUES (1, '/')")
+        self.db.executemany(
+            'INSERT INTO command_history '
+            '(id, command_id, directory_id, start_time, exit_code) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(1, 1, 1, '2013-01-01 00:00:00', 0), (2, None, None, None, None)])
+        self.db.commit()
+        migrate(self.db)
+        self.assertEqual(
+            self.db.execute(
+                'SELECT fingerprint FROM command_history ORDER BY id'
+            ).fetchall(),
+            [(command_fingerprint(['ls', '/', None, '2013-01-01 00:00:00',
+                                   None, 0]),),
+             (command_fingerprint([None] * 6),)])
+
+    def test_merge_duplicated_environment_variables(self):
+        self.db.executemany(
+            'INSERT INTO environment_variable '
+            '(id, variable_name, variable_value) VALUES (?, ?, ?)',
+            [(1, 'PATH', '/bin'), (2, 'PATH', '/bin'), (3, 'HOME', '/')])
+        self.db.executemany(
+            'INSERT INTO command_environment_map (ch_id, ev_id) '
+            'VALUES (?, ?)', [(1, 1), (2, 2), (2, 3)])
+        self.db.execute(
+            'INSERT INTO session_environment_map (sh_id, ev_id) '
+            'VALUES (1, 2)')
+        self.db.commit()
+        migrate(self.db)
+
+        self.assertEqual(
+            self.db.execute(
+                'SELECT id, variable_name FROM environment_variable '
+                'ORDER BY id').fetchall(),
+            [(1, 'PATH'), (3, 'HOME')])
+        self.assertEqual(
+            self.db.execute(
+                'SELECT ch_id, ev_id FROM command_environment_map '
+                'ORDER BY ch_id, ev_id').fetchall(),
+            [(1, 1), (2, 1), (2, 3)])
+        self.assertEqual(
+            self.db.execute(
+                'SELECT ev_id FROM session_environment_map').fetchall(),
+            [(1,)])
+        self.assertRaises(
+            sqlite3.IntegrityError, self.db.execute,
+            'INSERT INTO environment_variable '
+            '(variable_name, variable_value) VALUES (?, ?)',
+            ['PATH', '/bin'])
+
+    def test_backfill_program_name(self):
+        self.db.executemany(
+            'INSERT INTO command_list (command) VALUES (?)',
+            [('git status',), ('EDITOR=vi git commit',), ('ls',)])
+        self.db.commit()
+        migrate(self.db)
+        self.assertEqual(
+            self.db.execute(
+                'SELECT program_name FROM command_list ORDER BY id'
+            ).fetchall(),
+            [('git',), ('git',), ('ls',)])
+
+    def test_backfill_command_stats(self):
+        self.db.executemany(
+            'INSERT INTO command_list (id, command) VALUES (?, ?)',
+            [(1, 'A'), (2, 'B')])
+        self.db.executemany(
+            'INSERT INTO command_history '
+            '(id, command_id, start_time, exit_code) VALUES (?, ?, ?, ?)',
+            [(1, 1, '2013-01-02', 0), (2, 1, '2013-01-01', 1),
+             (3, 2, None, 0), (4, None, None, 0)])
+        self.db.commit()
+        migrate(self.db)
+        self.assertEqual(
+            self.db.execute(
+                'SELECT command_id, count, success_count, first_start, '
+                'last_start, last_id FROM command_stats ORDER BY command_id'
+            ).fetchall(),
+            [(0, 1, 1, None, None, 4),
+             (1, 2, 1, '2013-01-01', '2013-01-02', 1),
+             (2, 1, 1, None, None, 3)])
+
+        # Then it is updated for each new command:
+        self.db.execute(
+            'INSERT INTO command_history '
+            '(command_id, start_time, exit_code) VALUES (1, ?, 0)',
+            ['2013-01-03'])
+        self.assertEqual(
+            self.db.execute(
+                'SELECT count, success_count, last_start, last_id '
+                'FROM command_stats WHERE command_id = 1').fetchone(),
+            (3, 2, '2013-01-03', 5))
+
+    def test_backfill_command_fts(self):
+        self.db.executemany(
+            'INSERT INTO command_list (id, command) VALUES (?, ?)',
+            [(1, 'git status'), (2, 'ls')])
+        self.db.commit()
+        migrate(self.db)
+        if 'command_fts' not in [row[0] for row in self.db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")]:
+            self.skipTest('FTS5 trigram tokenizer is not available')
+        self.assertEqual(
+            self.db.execute(
+                "SELECT rowid FROM command_fts WHERE command_fts MATCH 'tat'"
+            ).fetchall(),
+            [(1,)])
+
+    def test_backfill_epoch_columns(self):
+        self.db.executemany(
+            'INSERT INTO command_history (id, start_time, stop_time) '
+            'VALUES (?, ?, ?)',
+            [(1, '1970-01-01 00:01:00', '1970-01-01 00:11:00.5'),
+             (2, '1970-01-01 00:01:00', None)])
+        self.db.commit()
+        migrate(self.db)
+        self.assertEqual(
+            self.db.execute(
+                'SELECT start_ts, stop_ts, duration FROM command_history '
+                'ORDER BY id').fetchall(),
+            [(60, 660, 600), (60, None, None)])
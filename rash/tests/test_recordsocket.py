@@ -0,0 +1,72 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import socket
+import tempfile
+import shutil
+
+from ..recordsocket import send_record, RecordReceiver
+from .utils import BaseTestCase, skipIf
+
+
+@skipIf(not hasattr(socket, 'AF_UNIX'), "Unix domain socket is required")
+class TestRecordSocket(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.socket_path = os.path.join(self.base_path, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_send_without_daemon(self):
+        self.assertFalse(send_record(self.socket_path, 'command', {}))
+
+    def test_send_and_receive(self):
+        receiver = RecordReceiver(self.socket_path)
+        try:
+            records = [('init', {'session_id': 'SID'}),
+                       ('command', {'session_id': 'SID', 'command': 'ls'})]
+            for (record_type, data) in records:
+                self.assertTrue(
+                    send_record(self.socket_path, record_type, data))
+            self.assertEqual(list(receiver.receive(0)), records)
+        finally:
+            receiver.close()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertFalse(send_record(self.socket_path, 'command', {}))
+
+    def test_receive_after_unlink(self):
+        receiver = RecordReceiver(self.socket_path)
+        try:
+            self.assertTrue(send_record(self.socket_path, 'command', {}))
+            receiver.unlink()
+            self.assertFalse(os.path.exists(self.socket_path))
+            self.assertFalse(send_record(self.socket_path, 'exit', {}))
+            self.assertEqual(list(receiver.receive(0)), [('command', {})])
+            # Socket of a new daemon is not removed:
+            other = RecordReceiver(self.socket_path)
+            receiver.close()
+            self.assertTrue(os.path.exists(self.socket_path))
+            other.close()
+        finally:
+            receiver.close()
+
+    def test_send_to_stale_socket(self):
+        RecordReceiver(self.socket_path).sock.close()
+        self.assertTrue(os.path.exists(self.socket_path))
+        self.assertFalse(send_record(self.socket_path, 'command', {}))
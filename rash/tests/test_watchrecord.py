@@ -0,0 +1,76 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import signal
+import threading
+
+from ..watchrecord import get_batch, stop_on_signals, receive_records, \
+    Queue
+from .utils import BaseTestCase
+
+
+class TestGetBatch(BaseTestCase):
+
+    def make_queue(self, num):
+        queue = Queue()
+        for i in range(num):
+            queue.put(i)
+        return queue
+
+    def test_empty_queue(self):
+        self.assertEqual(get_batch(Queue(), 0, 0, 10), [])
+
+    def test_batch_size(self):
+        queue = self.make_queue(25)
+        self.assertEqual(get_batch(queue, 0, 0, 10), list(range(10)))
+        self.assertEqual(get_batch(queue, 0, 0, 10), list(range(10, 20)))
+        self.assertEqual(get_batch(queue, 0, 0.01, 10), list(range(20, 25)))
+        self.assertTrue(queue.empty())
+
+
+class TestStopOnSignals(BaseTestCase):
+
+    def test_signal_sets_stop(self):
+        stop = threading.Event()
+        handlers = stop_on_signals(stop, [signal.SIGUSR1])
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertTrue(stop.wait(1))
+        finally:
+            signal.signal(signal.SIGUSR1, handlers[signal.SIGUSR1])
+
+
+class EndlessReceiver(object):
+
+    def receive(self, timeout=None):
+        while True:
+            yield ('command', {})
+
+
+class TestReceiveRecords(BaseTestCase):
+
+    def test_stop_under_steady_traffic(self):
+        queue = Queue()
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=receive_records, args=(EndlessReceiver(), queue, stop))
+        thread.daemon = True
+        thread.start()
+        queue.get(timeout=1)
+        stop.set()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
@@ -0,0 +1,77 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import heapq
+
+
+class LRUCache(object):
+
+    """
+    Mapping which discards the least recently used items.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache
+    False
+    >>> (cache.get('a'), cache.get('c'))
+    (1, 3)
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = {}
+        self._used = {}
+        self._clock = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _touch(self, key):
+        self._clock += 1
+        self._used[key] = self._clock
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._touch(key)
+            return self._data[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._touch(key)
+        if len(self._data) > self.maxsize:
+            # Finding the least recently used item needs a scan, so
+            # discard a tenth of the items at once.
+            num = len(self._data) - self.maxsize + self.maxsize // 10
+            for old in heapq.nsmallest(num, self._used,
+                                       key=self._used.__getitem__):
+                self.pop(old)
+
+    def pop(self, key, default=None):
+        self._used.pop(key, None)
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+        self._used.clear()
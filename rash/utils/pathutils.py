@@ -16,6 +16,8 @@
 
 import os
 
+from .py3compat import scandir
+
 
 def mkdirp(path):
     """
@@ -23,3 +25,36 @@ def mkdirp(path):
     """
     if not os.path.isdir(path):
         os.makedirs(path)
+
+
+def walk_files(top, suffix=''):
+    """
+    Yield ``(path, stat)`` of files under `top` in sorted order.
+
+    Only the files whose name ends with `suffix` are yielded.
+    :func:`os.scandir` is used if available, as it does not need to
+    call stat for each entry to tell directories from files.
+
+    """
+    if scandir is None:
+        names = sorted(os.listdir(top))
+        entries = [(n, os.path.join(top, n)) for n in names]
+        for (name, path) in entries:
+            if os.path.isdir(path):
+                for item in walk_files(path, suffix):
+                    yield item
+            elif name.endswith(suffix):
+                yield (path, os.stat(path))
+        return
+    it = scandir(top)
+    try:
+        entries = sorted(it, key=lambda e: e.name)
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    for entry in entries:
+        if entry.is_dir():
+            for item in walk_files(entry.path, suffix):
+                yield item
+        elif entry.name.endswith(suffix):
+            yield (entry.path, entry.stat())
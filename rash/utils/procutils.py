@@ -0,0 +1,32 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def get_process_context():
+    """
+    Return a :mod:`multiprocessing` context which starts processes
+    without forking this process, or None if it is not supported
+    (Python < 3.4).
+
+    Forking a process while other threads may hold locks can deadlock
+    the child processes.
+
+    """
+    import multiprocessing
+    if not hasattr(multiprocessing, 'get_context'):
+        return None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
@@ -47,3 +47,21 @@ try:
     from itertools import izip as zip
 except ImportError:
     zip = zip
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+try:
+    execfile = execfile
+except NameError:
+    def execfile(filename, globals):
+        with open(filename) as f:
+            code = compile(f.read(), filename, 'exec')
+        exec(code, globals)
+
+try:
+    unichr = unichr
+except NameError:
+    unichr = chr
@@ -240,6 +240,41 @@ class SQLConstructor(object):
         self.conditions.extend(concat_expr('OR', expr))
         self.params.extend(flatten(params))
 
+    def add_condition(self, condition, params=[]):
+        """
+        Add a raw `condition` with `params` to the WHERE clause.
+
+        >>> sc = SQLConstructor('main', ['c1'])
+        >>> sc.add_condition('c1 IN (1, 2)')
+        >>> sc.compile()[0]
+        'SELECT c1 FROM main WHERE c1 IN (1, 2)'
+
+        """
+        self.conditions.append(condition)
+        self.params.extend(params)
+
+    def add_in_subquery(self, lhs, source):
+        """
+        Add condition that `lhs` is in the result of `source`.
+
+        >>> sc = SQLConstructor('main', ['c1', 'c2'])
+        >>> subsc = SQLConstructor('sub', ['d1'])
+        >>> subsc.add_or_matches('{0} = {1}', 'd2', ['abc'])
+        >>> sc.add_in_subquery('c1', subsc)
+        >>> (sql, params, keys) = sc.compile()
+        >>> print(sql)                     # doctest: +NORMALIZE_WHITESPACE
+        SELECT c1, c2 FROM main
+        WHERE c1 IN ( SELECT d1 FROM sub WHERE (d2 = ?) )
+        >>> params
+        ['abc']
+
+        :type source: SQLConstructor
+        :arg  source: subquery selecting one column.
+
+        """
+        (sql, params, _) = source.compile()
+        self.add_condition('{0} IN ( {1} )'.format(lhs, sql), params)
+
     def add_matches(self, matcher, lhs,
                     match_params=[], include_params=[], exclude_params=[],
                     numq=1, flatten=None):
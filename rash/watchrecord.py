@@ -16,25 +16,64 @@
 
 import time
 import signal
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from .journal import is_journal_file
+from .utils.pathutils import mkdirp
 
 try:
     from watchdog.events import (
-        FileSystemEventHandler, FileCreatedEvent)
+        FileSystemEventHandler, FileCreatedEvent, FileModifiedEvent,
+        FileMovedEvent)
     assert FileSystemEventHandler  # fool pyflakes
 except ImportError:
     # Dummy class for making this module importable:
     FileSystemEventHandler = object
 
 
+def is_record_file(path):
+    return path.endswith('.json')
+
+
 class RecordHandler(FileSystemEventHandler):
 
-    def __init__(self, indexer, **kwds):
-        self.__indexer = indexer
+    """
+    Put records and journals to be indexed into a queue.
+
+    Items in the queue are ones accepted by
+    :meth:`rash.indexer.Indexer.index_batch`.
+
+    """
+
+    def __init__(self, queue, **kwds):
+        self.__queue = queue
         super(RecordHandler, self).__init__(**kwds)
 
+    def index(self, path):
+        if is_journal_file(path):
+            self.__queue.put(('journal', path))
+        elif is_record_file(path):
+            self.__queue.put(('record', path))
+
     def on_created(self, event):
         if isinstance(event, FileCreatedEvent):
-            self.__indexer.index_record(event.src_path)
+            self.index(event.src_path)
+
+    def on_moved(self, event):
+        # Records written by the native recorder are renamed from
+        # temporary files.
+        if isinstance(event, FileMovedEvent):
+            self.index(event.dest_path)
+
+    def on_modified(self, event):
+        if isinstance(event, FileModifiedEvent) and \
+           is_journal_file(event.src_path):
+            self.__queue.put(('journal', event.src_path))
 
 
 def raise_keyboardinterrupt(_signum, _frame):
@@ -45,11 +84,87 @@ def install_sigterm_handler():
     signal.signal(signal.SIGTERM, raise_keyboardinterrupt)
 
 
-def watch_record(indexer, use_polling=False):
+def stop_on_signals(stop, signums=(signal.SIGINT, signal.SIGTERM)):
     """
-    Start watching `cfstore.record_path`.
+    Set `stop` on `signums` instead of raising KeyboardInterrupt.
+
+    Return a dict of the previous handlers.
+
+    :type stop: threading.Event
 
-    :type indexer: rash.indexer.Indexer
+    """
+    def handler(_signum, _frame):
+        stop.set()
+    return dict((signum, signal.signal(signum, handler))
+                for signum in signums)
+
+
+def receive_records(receiver, queue, stop):
+    """
+    Put records sent to `receiver` into `queue` until `stop` is set.
+
+    :type receiver: rash.recordsocket.RecordReceiver
+    :type     stop: threading.Event
+
+    """
+    while not stop.is_set():
+        for record in receiver.receive(1):
+            queue.put(('dict', record))
+            if stop.is_set():
+                break
+
+
+def get_batch(queue, timeout, debounce, batch_size):
+    """
+    Get up to `batch_size` items from `queue`.
+
+    Wait for the first item up to `timeout` seconds and then keep
+    collecting items arrived in `debounce` seconds.
+
+    """
+    try:
+        items = [queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    deadline = time.time() + debounce
+    while len(items) < batch_size:
+        remaining = deadline - time.time()
+        try:
+            if remaining > 0:
+                items.append(queue.get(timeout=remaining))
+            else:
+                items.append(queue.get_nowait())
+        except Empty:
+            break
+    return items
+
+
+def index_batch(indexer, items):
+    if items:
+        indexer.index_batch(items)
+
+
+def watch_record(indexer, use_polling=False, receiver=None,
+                 debounce=0.1, batch_size=1000):
+    """
+    Start watching `cfstore.record_path` and `cfstore.journal_path`.
+
+    :type    indexer: rash.indexer.Indexer
+    :type   receiver: rash.recordsocket.RecordReceiver or None
+    :arg    receiver: If given, records sent to the daemon socket are
+                      indexed while watching.
+    :type   debounce: float
+    :arg    debounce: Seconds to wait for more records before indexing.
+    :type batch_size: int
+    :arg  batch_size: Maximum number of records indexed in one
+                      transaction.
+
+    Records are indexed by the calling thread only, in batches
+    collected by :func:`get_batch`.  SIGINT and SIGTERM stop watching
+    after the current batch is indexed, so that no batch taken from
+    the queue is lost by an interrupted transaction.  The socket of
+    `receiver` is removed first, so that records are sent to the
+    journal instead, and the records already sent are indexed.
 
     """
     if use_polling:
@@ -58,17 +173,41 @@ def watch_record(indexer, use_polling=False):
     else:
         from watchdog.observers import Observer
 
-    event_handler = RecordHandler(indexer)
+    queue = Queue()
+    event_handler = RecordHandler(queue)
     observer = Observer()
     observer.schedule(event_handler, path=indexer.record_path, recursive=True)
+    mkdirp(indexer.journal_path)
+    observer.schedule(event_handler, path=indexer.journal_path)
     indexer.logger.debug('Start observer.')
     observer.start()
+    stop = threading.Event()
+    if receiver:
+        receiver_thread = threading.Thread(
+            target=receive_records, args=(receiver, queue, stop))
+        receiver_thread.daemon = True
+        receiver_thread.start()
+    handlers = stop_on_signals(stop)
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        indexer.logger.debug('Got KeyboardInterrupt. Stopping observer.')
-        observer.stop()
+        while not stop.is_set():
+            index_batch(indexer, get_batch(queue, 1, debounce, batch_size))
+    finally:
+        for (signum, handler) in handlers.items():
+            signal.signal(signum, handler)
+    indexer.logger.debug('Got signal. Stopping observer.')
+    stop.set()
+    if receiver:
+        # Let "rash record" fall back to the journal from now on.
+        receiver.unlink()
+    observer.stop()
     indexer.logger.debug('Joining observer.')
     observer.join()
+    if receiver:
+        receiver_thread.join()
+        for record in receiver.receive(0):
+            queue.put(('dict', record))
+    # Records sent via socket are only in the queue.  Do not lose them.
+    indexer.logger.debug('Indexing %d queued records.', queue.qsize())
+    while not queue.empty():
+        index_batch(indexer, get_batch(queue, 0, 0, batch_size))
     indexer.logger.debug('Finish watching record.')